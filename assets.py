@@ -0,0 +1,201 @@
+# assets.py - Static asset cache with gzip variants and ETags
+
+import binascii
+import hashlib
+
+from microdot import Response
+
+try:
+    import gzip
+    gzip_compress = gzip.compress
+except (ImportError, AttributeError):
+    try:
+        import io
+        import deflate
+
+        def gzip_compress(data):
+            buf = io.BytesIO()
+            with deflate.DeflateIO(buf, deflate.GZIP) as f:
+                f.write(data)
+            return buf.getvalue()
+    except ImportError:
+        gzip_compress = None
+
+
+def file_size(filename):
+    """Size of a file in bytes, or ``None`` if it does not exist."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.seek(0, 2)
+    except OSError:
+        return None
+
+
+def safe_path(path):
+    """Return ``path`` if it is a plain relative path that stays inside the
+    directory it is joined to, else ``None``."""
+    if not path or path[0] == '/' or '\\' in path:
+        return None
+    for segment in path.split('/'):
+        if segment in ('', '.', '..'):
+            return None
+    return path
+
+
+class MemoryFile:
+    """Read-only file object over an in-memory buffer. Reads return slices
+    of the buffer instead of copies."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, n=-1):
+        start = self.pos
+        self.pos = len(self.data) if n < 0 else min(start + n, len(self.data))
+        return self.data[start:self.pos]
+
+    def close(self):
+        pass
+
+
+class Asset:
+    def __init__(self, filename, data, gz, etag, max_age, size, gz_size):
+        self.filename = filename
+        self.data = data        # None when the asset is streamed from flash
+        self.gz = gz            # in-memory gzip variant, if any
+        self.etag = etag
+        self.max_age = max_age
+        self.size = size
+        self.gz_size = gz_size  # 0 when there is no gzip variant
+
+
+class AssetCache:
+    """Serves static files with caching headers.
+
+    Small text assets are held in RAM together with a gzip variant when it
+    compresses well. A precompressed ``<filename>.gz`` on flash is used if
+    present, otherwise the variant is compressed at load time when the
+    firmware has a compressor available. Assets loaded with ``stream=True``
+    (images, anything large) stay on flash and are streamed through
+    :meth:`Response.send_file`, so the memory they use while being sent is
+    one fixed-size buffer no matter how large they are.
+
+    Responses carry an ETag and ``Cache-Control``, and requests with a
+    matching ``If-None-Match`` get ``304 Not Modified``.
+    """
+
+    def __init__(self, max_age=86400):
+        self.max_age = max_age
+        self.assets = {}
+
+    def add(self, path, data, filename=None, gz=None, max_age=None):
+        if isinstance(data, str):
+            data = data.encode()
+        if gz is None and gzip_compress is not None:
+            gz = gzip_compress(data)
+        if gz is not None and len(gz) > len(data) * 9 // 10:
+            # Images and other compressed formats don't gain anything
+            gz = None
+        self.assets[path] = Asset(
+            filename or path.split('/')[-1], data, gz,
+            self._etag(hashlib.sha1(data)),
+            self.max_age if max_age is None else max_age,
+            len(data), len(gz) if gz is not None else 0)
+
+    def load(self, path, filename, max_age=None, stream=False):
+        size = file_size(filename)
+        if size is None:
+            raise OSError('asset not found: ' + filename)
+        gz_size = file_size(filename + '.gz') or 0
+        if not stream:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            gz = None
+            if gz_size:
+                with open(filename + '.gz', 'rb') as f:
+                    gz = f.read()
+            self.add(path, data, filename=filename, gz=gz, max_age=max_age)
+            return
+
+        # Only the metadata stays in RAM; hash the file once in chunks for the
+        # ETag
+        digest = hashlib.sha1()
+        buf = bytearray(Response.send_file_buffer_size)
+        with open(filename, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digest.update(buf if n == len(buf) else buf[:n])
+        if gz_size >= size * 9 // 10:
+            gz_size = 0
+        self.assets[path] = Asset(filename, None, None, self._etag(digest),
+                                  self.max_age if max_age is None
+                                  else max_age, size, gz_size)
+
+    @staticmethod
+    def _etag(digest):
+        return binascii.hexlify(digest.digest()[:8]).decode()
+
+    def url(self, path):
+        """Path with a version query string, so references to an asset change
+        whenever its content does and long cache lifetimes are safe. An asset
+        that isn't loaded keeps its plain path."""
+        asset = self.assets.get(path)
+        return path if asset is None else path + '?v=' + asset.etag
+
+    def response(self, request, path):
+        """Response for a cached asset, or a 404 response if it wasn't
+        loaded."""
+        asset = self.assets.get(path)
+        if asset is None:
+            return 'Not found', 404
+        use_gz = asset.gz_size > 0 and request is not None and \
+            'gzip' in request.headers.get('Accept-Encoding', '')
+        etag = '"' + asset.etag + ('-gz"' if use_gz else '"')
+
+        status_code = 200
+        if request is not None and 'If-None-Match' in request.headers:
+            for tag in request.headers['If-None-Match'].split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == etag or tag == '*':
+                    status_code = 304
+                    break
+
+        if status_code == 304 or asset.data is not None:
+            body = b''
+            if status_code == 200:
+                body = asset.gz if use_gz else asset.data
+            res = Response.send_file(asset.filename, status_code=status_code,
+                                     stream=MemoryFile(body),
+                                     max_age=asset.max_age, compressed=use_gz)
+            if status_code == 304:
+                res.reason = 'Not Modified'
+                res.body = b''
+            res.headers['Content-Length'] = str(
+                asset.gz_size if use_gz else asset.size)
+        else:
+            res = Response.send_file(asset.filename, max_age=asset.max_age,
+                                     compressed=use_gz,
+                                     file_extension='.gz' if use_gz else '')
+        res.headers['ETag'] = etag
+        if asset.gz_size:
+            res.headers['Vary'] = 'Accept-Encoding'
+        return res
+
+
+def send_static(request, directory, path, max_age=None):
+    """Stream a file from a directory on flash, or return a 404 response if
+    it does not exist. A precompressed ``.gz`` sibling is sent to clients
+    that accept gzip."""
+    path = safe_path(path)
+    if path is None or file_size(directory + '/' + path) is None:
+        return 'Not found', 404
+    filename = directory + '/' + path
+    use_gz = 'gzip' in request.headers.get('Accept-Encoding', '') and \
+        file_size(filename + '.gz') is not None
+    return Response.send_file(filename, max_age=max_age, compressed=use_gz,
+                              file_extension='.gz' if use_gz else '')
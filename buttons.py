@@ -0,0 +1,91 @@
+# buttons.py - Interrupt-driven pushbuttons with debouncing and gestures
+
+import time
+
+import machine
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Gestures reported to the handler
+PRESS = 'press'
+DOUBLE_PRESS = 'double_press'
+LONG_PRESS = 'long_press'
+
+
+class Button:
+    """An active-low pushbutton on a pin with the internal pull-up enabled.
+
+    Both edges raise a pin interrupt, which only records the time and sets a
+    ``ThreadSafeFlag``. :meth:`run` sleeps on that flag, so an idle button
+    costs nothing. After an edge the level is read once the contacts have
+    been quiet for ``debounce_ms``.
+
+    Gestures are reported to the handler given to :meth:`run`:
+
+    * ``LONG_PRESS`` as soon as the button has been held for ``long_ms``.
+    * ``DOUBLE_PRESS`` when a second press starts within ``double_ms`` of
+      the first release.
+    * ``PRESS`` otherwise, ``double_ms`` after the release.
+    """
+
+    def __init__(self, pin_id, debounce_ms=50, long_ms=1500, double_ms=350):
+        self.pin = machine.Pin(pin_id, machine.Pin.IN, machine.Pin.PULL_UP)
+        self.debounce_ms = debounce_ms
+        self.long_ms = long_ms
+        self.double_ms = double_ms
+        self.flag = asyncio.ThreadSafeFlag()
+        self.edge_ticks = time.ticks_ms()
+        self.level = self.pin.value()
+        self.pin.irq(handler=self.irq,
+                     trigger=machine.Pin.IRQ_FALLING | machine.Pin.IRQ_RISING)
+
+    def irq(self, pin):
+        # Runs in interrupt context: no allocation, no event loop calls
+        # other than setting the flag
+        self.edge_ticks = time.ticks_ms()
+        self.flag.set()
+
+    async def wait_edge(self, timeout_ms=None):
+        """Wait for the pin to change and settle, and update ``level``.
+        Returns ``False`` if ``timeout_ms`` elapses first."""
+        if timeout_ms is None:
+            await self.flag.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(self.flag.wait(), timeout_ms)
+            except asyncio.TimeoutError:
+                return False
+        # Every bounce pushes edge_ticks forward; wait until they stop
+        while True:
+            quiet = time.ticks_diff(time.ticks_ms(), self.edge_ticks)
+            if quiet >= self.debounce_ms:
+                break
+            await asyncio.sleep_ms(self.debounce_ms - quiet)
+        self.level = self.pin.value()
+        return True
+
+    async def wait_level(self, level, timeout_ms=None):
+        """Wait for the debounced level, returning ``False`` on timeout."""
+        if timeout_ms is not None:
+            deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+        while self.level != level:
+            if timeout_ms is not None:
+                timeout_ms = max(time.ticks_diff(deadline, time.ticks_ms()), 0)
+            if not await self.wait_edge(timeout_ms):
+                return False
+        return True
+
+    async def run(self, handler):
+        while True:
+            await self.wait_level(0)
+            if not await self.wait_level(1, self.long_ms):
+                handler(LONG_PRESS)
+                await self.wait_level(1)
+            elif await self.wait_level(0, self.double_ms):
+                handler(DOUBLE_PRESS)
+                await self.wait_level(1)
+            else:
+                handler(PRESS)
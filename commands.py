@@ -0,0 +1,177 @@
+# commands.py - Air up/air down command state and the controller that runs them
+
+import time
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Where a cancel came from, for the run log
+SOURCE_API = 'api'
+SOURCE_WEBSOCKET = 'websocket'
+SOURCE_BUTTON = 'button'
+
+
+class PressureCommand:
+    """State of one pressure command (air up or air down).
+
+    ``model`` is the :class:`planner.FlowModel` the control loop plans
+    valve pulses with; it is kept from one run to the next.
+    """
+    __slots__ = ('name', 'label', 'direction', 'relay', 'max_valve_time',
+                 'running', 'cancel', 'cancel_source', 'start_ticks',
+                 'target_psi', 'task', 'run_id', 'model')
+
+    def __init__(self, name, label, direction, relay, max_valve_time, model):
+        self.name = name
+        self.label = label                    # display name for API messages
+        self.direction = direction            # +1 raises pressure, -1 lowers it
+        self.relay = relay                    # valve opened while adjusting
+        self.max_valve_time = max_valve_time  # seconds
+        self.running = False
+        self.cancel = False
+        self.cancel_source = None             # SOURCE_* of the last cancel
+        self.start_ticks = 0
+        self.target_psi = None
+        self.task = None
+        self.run_id = 0                       # bumped on every start
+        self.model = model
+
+    def elapsed(self):
+        """Seconds since the command started, or 0 if it isn't running."""
+        if not self.running:
+            return 0
+        return time.ticks_diff(time.ticks_ms(), self.start_ticks) / 1000
+
+
+class CommandController:
+    """Starts, cancels and reports on the pressure commands.
+
+    Only one command runs at a time: starting one while the other is running
+    is refused, and a command started right after the other was cancelled
+    waits for the cancelled one to close its valve first. Every transport
+    (REST, WebSocket, buttons) goes through :meth:`action`, which returns
+    the API response.
+
+    :param commands: the :class:`PressureCommand` objects to control.
+    :param run: coroutine function that adjusts the pressure for a command
+                until it reaches ``target_psi`` or ``cancel`` is set.
+    :param target: function returning the target pressure for a command.
+    :param on_change: called whenever a command starts or stops.
+    """
+
+    def __init__(self, commands, run, target, on_change):
+        self.commands = {}
+        for command in commands:
+            self.commands[command.name] = command
+        self.run = run
+        self.target = target
+        self.on_change = on_change
+        self.last_task = None
+
+    def active(self):
+        """The running command, or ``None``."""
+        for command in self.commands.values():
+            if command.running:
+                return command
+        return None
+
+    def status(self, command):
+        """Current status of a command, as reported by the API"""
+        return {
+            'status': 'running' if command.running else 'idle',
+            'command': command.name,
+            'time': command.elapsed()
+        }
+
+    def start(self, command):
+        if command.running:
+            return {
+                'status': 'already_running',
+                'command': command.name,
+                'message': f'{command.label} operation already in progress'
+            }
+        active = self.active()
+        if active is not None:
+            return {
+                'status': 'busy',
+                'command': command.name,
+                'message': f'{active.label} operation in progress'
+            }
+        # cancel stays set until the previous run has wound down, so a
+        # cancelled run of this same command doesn't pick up again
+        command.running = True
+        command.run_id += 1
+        command.start_ticks = time.ticks_ms()
+        command.target_psi = float(self.target(command))
+        print(f"{command.name} started with target {command.target_psi} PSI")
+        command.task = asyncio.create_task(
+            self._run(command, command.run_id, self.last_task))
+        self.last_task = command.task
+        self.on_change()
+        return {
+            'status': 'started',
+            'command': command.name,
+            'message': f'{command.label} operation started'
+        }
+
+    def cancel(self, command, source=None):
+        if not command.running:
+            return {
+                'status': 'not_running',
+                'command': command.name,
+                'message': f'No {command.label.lower()} operation in progress'
+            }
+        command.cancel = True
+        command.cancel_source = source
+        command.running = False
+        self.on_change()
+        return {
+            'status': 'cancelled',
+            'command': command.name,
+            'message': f'{command.label} operation cancelled'
+        }
+
+    def cancel_all(self, source=None):
+        for command in self.commands.values():
+            if command.running:
+                self.cancel(command, source)
+
+    def action(self, name, action, source=None):
+        """Apply a start/cancel/status action to a command, returning the API
+        response. ``source`` says which transport asked (``SOURCE_*``)."""
+        command = self.commands[name]
+        if action == 'status':
+            return self.status(command)
+        elif action == 'start':
+            return self.start(command)
+        elif action == 'cancel':
+            return self.cancel(command, source)
+        return {
+            'status': 'error',
+            'command': name,
+            'message': f"Unknown action: {action}"
+        }
+
+    async def _run(self, command, run_id, previous):
+        try:
+            if previous is not None and not previous.done():
+                # A cancelled command notices within one valve check; let it
+                # close its valve before this one opens one
+                try:
+                    await previous
+                except Exception:
+                    # It failed; its own cleanup has closed its valve, and
+                    # its error must not take this run down with it
+                    pass
+            if command.running and command.run_id == run_id:
+                command.cancel = False
+                command.cancel_source = None
+                await self.run(command)
+        finally:
+            # Whatever happened, leave the valve closed
+            command.relay.value(0)
+            if command.run_id == run_id:
+                command.running = False
+            self.on_change()
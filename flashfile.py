@@ -0,0 +1,25 @@
+# flashfile.py - Crash-safe file replacement on the flash filesystem
+
+try:
+    import os
+except ImportError:
+    import uos as os
+
+
+def write_atomic(filename, data):
+    """Replace ``filename`` with ``data`` (bytes or str).
+
+    The data goes to ``<filename>.tmp`` first, which is then renamed over
+    the real file, so a power cut leaves either the old or the new copy
+    intact. Readers that want to recover from a cut between the two steps
+    can look at the ``.tmp`` copy as well.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb' if isinstance(data, (bytes, bytearray)) else 'w') as f:
+        f.write(data)
+    try:
+        os.rename(tmp, filename)
+    except OSError:
+        # FAT won't rename over an existing file
+        os.remove(filename)
+        os.rename(tmp, filename)
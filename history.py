@@ -0,0 +1,116 @@
+# history.py - Downsampled pressure history streamed from the telemetry log
+
+import struct
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import lagmon
+from telemetry import RECORD_SIZE
+
+CHUNK_SIZE = 1024         # bytes per chunk written to the client
+YIELD_EVERY = 256         # records read between yields to the event loop
+# Binary format (little endian): a header, then one point per 6 bytes
+BINARY_MAGIC = b'PSIH'
+BINARY_HEADER = '<4sI'    # magic, start time (s)
+BINARY_POINT = '<IH'      # ms since the start time, PSI * 100
+BINARY_POINT_SIZE = struct.calcsize(BINARY_POINT)
+
+
+def _add_bucket(chunk, n, binary, first, lo_t, lo_v, hi_t, hi_v):
+    """Encode a bucket's low and high points into ``chunk`` at ``n``,
+    returning the new length."""
+    if lo_t > hi_t:
+        lo_t, lo_v, hi_t, hi_v = hi_t, hi_v, lo_t, lo_v
+    for t, v in ((lo_t, lo_v), (hi_t, hi_v)):
+        if binary:
+            struct.pack_into(BINARY_POINT, chunk, n, t, v)
+            n += BINARY_POINT_SIZE
+        else:
+            if not first:
+                chunk[n:n + 2] = b', '
+                n += 2
+            text = b'[%d, %d.%02d]' % (t, v // 100, v % 100)
+            chunk[n:n + len(text)] = text
+            n += len(text)
+        first = False
+        if lo_t == hi_t:
+            break
+    return n
+
+
+async def stream(log, since=None, max_points=300, binary=False):
+    """Stream the pressure history recorded by a
+    :class:`telemetry.TelemetryLog` as an async generator of chunks.
+
+    The time from ``since`` (seconds on the log's clock; the start of the
+    log by default) to now is split into ``max_points // 2`` equal buckets,
+    and each bucket is reduced to its lowest and highest reading, in time
+    order. Buckets with a single reading pass it through, so sparse history
+    comes back whole, and spikes survive any amount of downsampling.
+
+    As JSON the body is ``{"start": <s>, "points": [[<ms>, <psi>], ...]}``;
+    in binary it is :data:`BINARY_HEADER` followed by :data:`BINARY_POINT`
+    records. Point times are in ms since ``start``. Chunks are built in one
+    preallocated buffer of about :data:`CHUNK_SIZE` bytes, each sent before
+    the next is built.
+    """
+    order = log.segment_order()
+    base = min([s[2] for s in order]) if order else log.now_s()
+    if since is not None and since > base:
+        base = since
+    buckets = max(max_points // 2, 1)
+    end = (log.now_s() - base + 1) * 1000
+    width = max(end // buckets + 1, 1)
+
+    # Room for a full bucket past CHUNK_SIZE
+    chunk = bytearray(CHUNK_SIZE + 64)
+    if binary:
+        struct.pack_into(BINARY_HEADER, chunk, 0, BINARY_MAGIC, base)
+        n = struct.calcsize(BINARY_HEADER)
+    else:
+        head = b'{"start": %d, "points": [' % base
+        chunk[:len(head)] = head
+        n = len(head)
+    first = True
+
+    bucket = None
+    count = 0
+    lo_t = lo_v = hi_t = hi_v = 0
+    seen = 0
+    for t, v in log.records(base, bytearray(64 * RECORD_SIZE)):
+        seen += 1
+        if seen % YIELD_EVERY == 0:
+            lagmon.mark('history')
+            await asyncio.sleep_ms(0)
+        if t < 0 or t > end:
+            # before ``since``, or (in a damaged log) after now
+            continue
+        # never more than ``buckets``, whatever the rounding of ``width``
+        b = min(t // width, buckets - 1)
+        if b == bucket:
+            if v < lo_v:
+                lo_t, lo_v = t, v
+            if v > hi_v:
+                hi_t, hi_v = t, v
+            continue
+        if count:
+            n = _add_bucket(chunk, n, binary, first, lo_t, lo_v, hi_t, hi_v)
+            first = False
+            if n >= CHUNK_SIZE:
+                yield memoryview(chunk)[:n]
+                n = 0
+        bucket = b
+        count = 1
+        lo_t = hi_t = t
+        lo_v = hi_v = v
+    if count:
+        n = _add_bucket(chunk, n, binary, first, lo_t, lo_v, hi_t, hi_v)
+
+    if not binary:
+        chunk[n:n + 2] = b']}'
+        n += 2
+    if n:
+        yield memoryview(chunk)[:n]
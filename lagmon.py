@@ -0,0 +1,140 @@
+# lagmon.py - Event loop lag watchdog with stall attribution
+
+import time
+from array import array
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Lag histogram bucket upper bounds, in microseconds
+LAG_BUCKETS_US = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000,
+                  500000, 1000000)
+
+_monitor = None
+
+
+def mark(label):
+    """Note that the code that ran since the previous mark was ``label``.
+
+    Tasks call this at the end of each chunk of work (a request, a sampler
+    tick, a flash write). It costs a ``ticks_us()`` call and does nothing
+    until a :class:`LagMonitor` is running.
+    """
+    if _monitor is not None:
+        _monitor.mark(label)
+
+
+class LagMonitor:
+    """Measures how late the event loop wakes a task up.
+
+    :meth:`run` sleeps for ``period_ms`` over and over and times, with
+    ``ticks_us``, how much later than asked it actually woke up. Any task
+    that runs for a long time without awaiting delays every other task's
+    wakeup by the same amount, including the valve timing loop.
+
+    Lags are counted in a fixed-bucket histogram, from which the 99th
+    percentile is estimated. A wakeup later than ``stall_ms`` is a stall,
+    and is blamed on the label whose stretch of time between two
+    :func:`mark` calls was the longest since the previous wakeup; the last
+    ``max_stalls`` stalls are kept.
+    """
+
+    def __init__(self, period_ms=20, stall_ms=50, max_stalls=8):
+        self.period_ms = period_ms
+        self.stall_us = stall_ms * 1000
+        self.max_stalls = max_stalls
+        self.counts = array('I', [0] * (len(LAG_BUCKETS_US) + 1))
+        self.reset()
+        self.mark_us = time.ticks_us()
+        self.worst_us = 0
+        self.worst_label = None
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.samples = 0
+        self.max_us = 0
+        self.max_label = None
+        self.stalls = []        # (ticks_ms, lag_us, label), oldest first
+        self.valve_pulses = 0
+        self.valve_overrun_max_ms = 0
+
+    def mark(self, label):
+        now = time.ticks_us()
+        elapsed = time.ticks_diff(now, self.mark_us)
+        if elapsed > self.worst_us:
+            self.worst_us = elapsed
+            self.worst_label = label
+        self.mark_us = now
+
+    def valve_pulse(self, planned_ms, actual_ms):
+        """Record how much longer than planned a valve stayed open."""
+        self.valve_pulses += 1
+        overrun = actual_ms - planned_ms
+        if overrun > self.valve_overrun_max_ms:
+            self.valve_overrun_max_ms = overrun
+
+    def observe(self, lag_us):
+        i = 0
+        for bound in LAG_BUCKETS_US:
+            if lag_us <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.samples += 1
+        if lag_us >= self.stall_us:
+            self.stalls.append((time.ticks_ms(), lag_us,
+                                self.worst_label or 'unmarked'))
+            if len(self.stalls) > self.max_stalls:
+                self.stalls.pop(0)
+        if lag_us > self.max_us:
+            self.max_us = lag_us
+            self.max_label = self.worst_label or 'unmarked'
+
+    def percentile_us(self, fraction):
+        """Upper bound of the bucket holding the given fraction of lags
+        (``None`` past the last bucket, or before any samples)."""
+        if not self.samples:
+            return None
+        target = self.samples * fraction
+        total = 0
+        for i, bound in enumerate(LAG_BUCKETS_US):
+            total += self.counts[i]
+            if total >= target:
+                return bound
+        return None
+
+    def status(self):
+        """Summary for the diagnostic route"""
+        now = time.ticks_ms()
+        p99 = self.percentile_us(0.99)
+        return {
+            'period_ms': self.period_ms,
+            'samples': self.samples,
+            'max_ms': self.max_us / 1000,
+            'max_label': self.max_label,
+            'p99_ms': p99 / 1000 if p99 is not None else None,
+            'stall_ms': self.stall_us / 1000,
+            'stalls': [{'age_s': time.ticks_diff(now, ticks) / 1000,
+                        'lag_ms': lag_us / 1000, 'label': label}
+                       for ticks, lag_us, label in self.stalls],
+            'valve_pulses': self.valve_pulses,
+            'valve_overrun_max_ms': self.valve_overrun_max_ms,
+        }
+
+    async def run(self):
+        global _monitor
+        _monitor = self
+        period_us = self.period_ms * 1000
+        while True:
+            self.mark(None)
+            self.worst_us = 0
+            self.worst_label = None
+            slept = time.ticks_us()
+            await asyncio.sleep_ms(self.period_ms)
+            woke = time.ticks_us()
+            # Close the stretch that ended with this wakeup
+            self.mark(None)
+            self.observe(max(time.ticks_diff(woke, slept) - period_us, 0))
@@ -5,21 +5,17 @@ import time
 import machine
 import ujson
 
-# Setpoint persistence helpers
+# Setpoint persistence helpers. The file is read once after WiFi setup (see
+# below); saves update RAM and are written to flash by setpoints.run() once
+# edits stop coming in.
 SETPOINTS_FILE = 'setpoints.json'
 
 def load_setpoints():
-    try:
-        with open(SETPOINTS_FILE) as f:
-            s = ujson.load(f)
-            return s.get('setpoint_onroad', 32), s.get('setpoint_offroad', 14)
-    except Exception as e:
-        print('Error loading setpoints:', e)
-        return 32, 14
+    return setpoints.get()
 
 def save_setpoints(s_onroad, s_offroad):
-    with open(SETPOINTS_FILE, 'w') as f:
-        ujson.dump({'setpoint_onroad': float(s_onroad), 'setpoint_offroad': float(s_offroad)}, f)
+    """Raises ValueError if either setpoint is invalid"""
+    setpoints.set(s_onroad, s_offroad)
 
 # Pin definitions (customize as needed)
 relay_pins = [12, 13, 14, 25]
@@ -29,81 +25,27 @@ vent_air_relay = relay_outputs[1]
 pressure_adc = machine.ADC(machine.Pin(32))
 pressure_adc.atten(machine.ADC.ATTN_11DB)
 
-# Digital inputs for buttons (active low, pull-up enabled)
-air_up_button = machine.Pin(5, machine.Pin.IN, machine.Pin.PULL_UP)
-air_down_button = machine.Pin(16, machine.Pin.IN, machine.Pin.PULL_UP)
-# --- Button monitoring task ---
-async def monitor_buttons():
-    debounce_ms = 50
-    last_up = 1
-    last_down = 1
-    up_pressed_time = 0
-    down_pressed_time = 0
-    while True:
-        up_val = air_up_button.value()
-        down_val = air_down_button.value()
-
-        # Debounce air up button
-        if up_val == 0 and last_up == 1:
-            up_pressed_time = time.ticks_ms()
-        if up_val == 0 and last_up == 0:
-            if time.ticks_diff(time.ticks_ms(), up_pressed_time) > debounce_ms:
-                # Button is debounced and pressed
-                print("Air Up button pressed")
-                if command_state['air_down']['running']:
-                    # Ignore if air_down is running
-                    pass
-                elif command_state['air_up']['running']:
-                    # Cancel air_up if running
-                    print("Cancelling Air Up command via button press")
-                    command_state['air_up']['cancel'] = True
-                    command_state['air_up']['running'] = False
-                else:
-                    # Start air_up if not running
-                    s_onroad, _ = load_setpoints()
-                    target_psi = float(s_onroad)
-                    command_state['air_up']['running'] = True
-                    command_state['air_up']['cancel'] = False
-                    command_state['air_up']['start_time'] = time.time()
-                    last_command_time['air_up'] = time.time()
-                    command_state['air_up']['target_psi'] = target_psi
-                    asyncio.create_task(adjust_pressure('air_up', target_psi))
-                # Wait for release to avoid retrigger
-                while air_up_button.value() == 0:
-                    await asyncio.sleep_ms(10)
-
-        # Debounce air down button
-        if down_val == 0 and last_down == 1:
-            down_pressed_time = time.ticks_ms()
-        if down_val == 0 and last_down == 0:
-            if time.ticks_diff(time.ticks_ms(), down_pressed_time) > debounce_ms:
-                # Button is debounced and pressed
-                print("Air Down button pressed")
-                if command_state['air_up']['running']:
-                    # Ignore if air_up is running
-                    pass
-                elif command_state['air_down']['running']:
-                    # Cancel air_down if running
-                    print("Cancelling Air Down command via button press")
-                    command_state['air_down']['cancel'] = True
-                    command_state['air_down']['running'] = False
-                else:
-                    # Start air_down if not running
-                    _, s_offroad = load_setpoints()
-                    target_psi = float(s_offroad)
-                    command_state['air_down']['running'] = True
-                    command_state['air_down']['cancel'] = False
-                    command_state['air_down']['start_time'] = time.time()
-                    last_command_time['air_down'] = time.time()
-                    command_state['air_down']['target_psi'] = target_psi
-                    asyncio.create_task(adjust_pressure('air_down', target_psi))
-                # Wait for release to avoid retrigger
-                while air_down_button.value() == 0:
-                    await asyncio.sleep_ms(10)
-
-        last_up = up_val
-        last_down = down_val
-        await asyncio.sleep_ms(10)
+# Buttons (active low, pull-up enabled), handled by buttons.Button
+AIR_UP_BUTTON_PIN = 5
+AIR_DOWN_BUTTON_PIN = 16
+
+# --- Button gestures ---
+def button_gesture(cmd, gesture):
+    """Act on a gesture from the Air Up or Air Down button"""
+    command = controller.commands[cmd]
+    print(f"{command.label} button: {gesture}")
+    if gesture == LONG_PRESS:
+        # Holding either button stops whatever is running
+        controller.cancel_all(SOURCE_BUTTON)
+    elif gesture == DOUBLE_PRESS:
+        # Double press switches direction even if the other command is running
+        controller.cancel_all(SOURCE_BUTTON)
+        controller.start(command)
+    elif command.running:
+        controller.cancel(command, SOURCE_BUTTON)
+    else:
+        # Refused while the other command is running
+        controller.start(command)
 
 # WiFi Access Point Setup
 ap = network.WLAN(network.AP_IF)
@@ -117,20 +59,126 @@ print('AP active, IP:', ap.ifconfig()[0])
 
 # Now import Microdot and asyncio (after WiFi is initialized)
 from microdot import Microdot, Response
+from microdot_websocket import with_websocket
+from assets import AssetCache, send_static
+from sampler import Sampler
+from buttons import Button, LONG_PRESS, DOUBLE_PRESS
+from commands import PressureCommand, CommandController, SOURCE_API, SOURCE_WEBSOCKET, SOURCE_BUTTON
+from planner import FlowModel, load_models, save_models
+from settle import SettleDetector
+from telemetry import TelemetryLog
+import runlog
+import history
+from metrics import Metrics
+import lagmon
+from setpoint_store import SetpointStore
 import uasyncio as asyncio
 
+setpoints = SetpointStore(SETPOINTS_FILE, defaults=(32, 14))
+
 # Set up Microdot
 app = Microdot()
 Response.default_content_type = 'application/json'
 
-# Load HTML layout from template
-with open("/layout.html", "r") as f:
-    html_template = f.read()
+# Allocation budget for the request path: the WiFi stack shares the heap, so
+# buffers, requests and responses are reused and the heap is collected
+# between requests rather than whenever it fills up mid-request
+HTTP_POOL_SIZE = 3              # Connection buffers, requests and responses kept
+HTTP_COLLECT_BYTES = 16 * 1024  # Allocation between collections
+HTTP_ALLOC_BUDGET = 4096        # Bytes a request should allocate at most
+app.pool_size = HTTP_POOL_SIZE
+app.collect_threshold = HTTP_COLLECT_BYTES
+app.alloc_budget = HTTP_ALLOC_BUDGET
+
+# Request, pressure and valve counters, served at /metrics (see metrics.py)
+metrics = Metrics()
+app.metrics = metrics
+
+# Event loop lag watchdog (see lagmon.py), proving long handlers or flash
+# writes don't hold a valve open past its planned time
+lag_monitor = lagmon.LagMonitor(period_ms=20, stall_ms=50)
+
+@app.route('/lag')
+def get_lag(request):
+    """Event loop lag and valve timing diagnostics; ``?reset=1`` starts the
+    statistics over"""
+    if request.args.get('reset'):
+        lag_monitor.reset()
+    return lag_monitor.status()
+
+@app.route('/metrics')
+def get_metrics(request):
+    """Prometheus text exposition of the counters in ``metrics``"""
+    return Response(body=metrics.chunks(), headers={
+        'Content-Type': 'text/plain; version=0.0.4',
+        'Cache-Control': 'no-cache',
+    })
+
+# Static assets are loaded into RAM once at boot and served with ETags,
+# Cache-Control and gzip variants (see assets.py). Pages reference them with
+# a version query string, so browsers can cache them for a long time and
+# still pick up new firmware.
+ASSET_MAX_AGE = 7 * 24 * 3600  # Seconds browsers may cache static assets
+assets = AssetCache(max_age=ASSET_MAX_AGE)
+
+def load_asset(path, filename, **kwargs):
+    """Add a file to the asset cache. A missing or unreadable file is
+    reported and left out, so its route answers 404 instead of the firmware
+    failing to start."""
+    try:
+        assets.load(path, filename, **kwargs)
+        return True
+    except OSError as e:
+        print('Error loading asset:', e)
+        return False
+
+def read_asset(filename):
+    """Text of a web file, or ``None`` (reported) if it can't be read."""
+    try:
+        with open(filename) as f:
+            return f.read()
+    except OSError as e:
+        print('Error loading asset:', filename, e)
+        return None
+
+# Images don't compress and are the largest files, so they are streamed
+# from flash rather than held in RAM
+load_asset('/tire.jpeg', 'tire.jpeg', stream=True)
+load_asset('/icon.png', 'icon.png', stream=True)
+
+# The page bundle built by tools/build_bundle.py, when uploaded, has the
+# stylesheet, script and background inlined so the page loads with one
+# transfer. It is streamed from flash (bundle.html.gz to gzip clients).
+try:
+    assets.load('/', 'bundle.html', max_age=0, stream=True)
+    use_bundle = True
+except OSError:
+    use_bundle = False
+
+if use_bundle:
+    # Only stale cached pages still ask for these; keep them out of RAM
+    load_asset('/script.js', 'script.js', stream=True)
+    load_asset('/style.css', 'style.css', stream=True)
+else:
+    load_asset('/script.js', 'script.js')
+    css = read_asset('style.css')
+    if css is not None:
+        css = css.replace("'./tire.jpeg'", "'" + assets.url('/tire.jpeg') + "'")
+        assets.add('/style.css', css, filename='style.css')
+
+    # Load HTML layout from template; it is revalidated on every page load
+    html_template = read_asset('/layout.html')
+    if html_template is not None:
+        for ref, path in (("'./icon.png'", '/icon.png'), ("'./style.css'", '/style.css'),
+                          ("'/script.js'", '/script.js')):
+            html_template = html_template.replace(ref, "'" + assets.url(path) + "'")
+        assets.add('/', html_template, filename='layout.html', max_age=0)
+    del css, html_template
 
 # Simple captive portal handler
 @app.route('/')
 def index(request):
-    return Response(body= html_template, headers={'Content-Type': 'text/html'})
+    return assets.response(request, '/')
 
 @app.route('/get_setpoints')
 def get_setpoints(request):
@@ -139,15 +187,39 @@ def get_setpoints(request):
 
 @app.route('/set_setpoints', methods=['POST'])
 def set_setpoints(request):
-    data = request.json
-    save_setpoints(data.get('setpoint_onroad', 0), data.get('setpoint_offroad', 0))
+    try:
+        data = request.json
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return {'status': 'error', 'message': 'Invalid JSON body'}, 400
+    try:
+        save_setpoints(data.get('setpoint_onroad'), data.get('setpoint_offroad'))
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}, 400
     return {'status': 'ok'}
 
-# --- Command state tracking dictionary ---
-command_state = {
-    'air_up': {'running': False, 'cancel': False, 'task': None},
-    'air_down': {'running': False, 'cancel': False, 'task': None}
-}
+# Broadcast of command state changes, so streaming clients (/events, /ws)
+# hear about transitions immediately instead of on their next check
+state_version = 0
+state_event = asyncio.Event()
+
+def notify_state():
+    """Wake every task waiting in wait_state_change()"""
+    global state_version, state_event
+    state_version += 1
+    event = state_event
+    state_event = asyncio.Event()
+    event.set()
+
+async def wait_state_change(seen_version, timeout):
+    """Wait until the state version moves past seen_version, or timeout"""
+    if state_version != seen_version:
+        return
+    try:
+        await asyncio.wait_for(state_event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
 
 # RESTful Air Command API
 
@@ -156,217 +228,267 @@ command_state = {
 def air_up(request):
     """RESTful endpoint for air up operations"""
     # Get action from URL parameters (default to 'start')
-    action = request.args.get('action', 'start')
-    cmd = 'air_up'
-    
-    if action == 'status':
-        # Status query doesn't change state
-        is_running = command_state[cmd]['running']
-        return {
-            'status': 'running' if is_running else 'idle',
-            'command': cmd,
-            'time': time.time() - last_command_time.get(cmd, 0) if is_running else 0
-        }
-    
-    elif action == 'start':
-        # Start command
-        if not command_state[cmd]['running']:
-            # Initialize command state
-            command_state[cmd]['running'] = True
-            command_state[cmd]['cancel'] = False
-            command_state[cmd]['start_time'] = time.time()
-            last_command_time[cmd] = time.time()
-            
-            # Load the on-road pressure setpoint for air_up
-            s_onroad, s_offroad = load_setpoints()
-            target_psi = float(s_onroad)
-            command_state[cmd]['target_psi'] = target_psi
-            
-            # Create async task for pressure adjustment
-            print(f"{cmd} started with target {target_psi} PSI")
-            asyncio.create_task(adjust_pressure(cmd, target_psi))
-            
-            return {
-                'status': 'started',
-                'command': cmd,
-                'message': 'Air up operation started'
-            }
-        else:
-            return {
-                'status': 'already_running',
-                'command': cmd,
-                'message': 'Air up operation already in progress'
-            }
-    
-    elif action == 'cancel':
-        # Cancel command
-        if command_state[cmd]['running']:
-            command_state[cmd]['cancel'] = True
-            command_state[cmd]['running'] = False
-            
-            # Clean up timers
-            if cmd in last_command_time:
-                del last_command_time[cmd]
-                
-            return {
-                'status': 'cancelled',
-                'command': cmd,
-                'message': 'Air up operation cancelled'
-            }
-        else:
-            return {
-                'status': 'not_running',
-                'command': cmd,
-                'message': 'No air up operation in progress'
-            }
-    
-    # Invalid action
-    return {
-        'status': 'error',
-        'command': cmd,
-        'message': f"Unknown action: {action}"
-    }
+    return controller.action('air_up', request.args.get('action', 'start'), SOURCE_API)
 
 # Air Down command API
 @app.route('/air_down', methods=['POST', 'GET'])
 def air_down(request):
     """RESTful endpoint for air down operations"""
     # Get action from URL parameters (default to 'start')
-    action = request.args.get('action', 'start')
-    cmd = 'air_down'
-    
-    if action == 'status':
-        # Status query doesn't change state
-        is_running = command_state[cmd]['running']
-        return {
-            'status': 'running' if is_running else 'idle',
-            'command': cmd,
-            'time': time.time() - last_command_time.get(cmd, 0) if is_running else 0
-        }
-    
-    elif action == 'start':
-        # Start command
-        if not command_state[cmd]['running']:
-            # Initialize command state
-            command_state[cmd]['running'] = True
-            command_state[cmd]['cancel'] = False
-            command_state[cmd]['start_time'] = time.time()
-            last_command_time[cmd] = time.time()
-            
-            # Load the off-road pressure setpoint for air_down
-            s_onroad, s_offroad = load_setpoints()
-            target_psi = float(s_offroad)
-            command_state[cmd]['target_psi'] = target_psi
-            
-            # Create async task for pressure adjustment
-            print(f"{cmd} started with target {target_psi} PSI")
-            asyncio.create_task(adjust_pressure(cmd, target_psi))
-            
-            return {
-                'status': 'started',
-                'command': cmd,
-                'message': 'Air down operation started'
-            }
-        else:
-            return {
-                'status': 'already_running',
-                'command': cmd,
-                'message': 'Air down operation already in progress'
-            }
-    
-    elif action == 'cancel':
-        # Cancel command
-        if command_state[cmd]['running']:
-            command_state[cmd]['cancel'] = True
-            command_state[cmd]['running'] = False
-            
-            # Clean up timers
-            if cmd in last_command_time:
-                del last_command_time[cmd]
-                
-            return {
-                'status': 'cancelled',
-                'command': cmd,
-                'message': 'Air down operation cancelled'
-            }
-        else:
-            return {
-                'status': 'not_running',
-                'command': cmd,
-                'message': 'No air down operation in progress'
-            }
-    
-    # Invalid action
-    return {
-        'status': 'error',
-        'command': cmd,
-        'message': f"Unknown action: {action}"
-    }
+    return controller.action('air_down', request.args.get('action', 'start'), SOURCE_API)
+
+# Pressure sensor is sampled by a background task (see sampler.py) so that
+# readers never touch the ADC or block the event loop
+PRESSURE_SAMPLE_RATE_HZ = 100  # ADC sampling rate
+PRESSURE_FILTER_WINDOW = 8     # Samples averaged into each reading (80ms)
+pressure_sampler = Sampler(pressure_adc, rate_hz=PRESSURE_SAMPLE_RATE_HZ,
+                           window=PRESSURE_FILTER_WINDOW)
 
 # Utility function for internal pressure reading
 def read_pressure():
-    """Read pressure sensor and return PSI value"""
-    # Average 16 readings for noise reduction
-    pres_raw = 0
-    for _ in range(16):
-        pres_raw += pressure_adc.read_uv()
-    pres_raw = pres_raw >> 4
-    pres_psi = (pres_raw - 500000) * 0.00005
+    """Return the latest filtered pressure sensor reading in PSI"""
+    started = time.ticks_us()
+    pres_psi = (pressure_sampler.value() - 500000) * 0.00005
     if pres_psi < 0.0:
         pres_psi = 0.0
+    metrics.pressure_read.observe(time.ticks_diff(time.ticks_us(), started))
     return pres_psi
 
-async def wait_for_stable_pressure(max_wait_time=5.0, stability_threshold=0.5):
+# Pressure history on flash (see telemetry.py): a record whenever the
+# pressure moves by TELEMETRY_DEADBAND or a minute passes, batched in RAM and
+# written at most every TELEMETRY_FLUSH_MS, in a file of fixed size. Its
+# clock (uptime added up over every boot) also timestamps the run log, since
+# time.time() starts over at every power-up
+TELEMETRY_FILE = 'telemetry.bin'
+TELEMETRY_MAX_BYTES = 128 * 1024  # ~32000 records
+TELEMETRY_SAMPLE_MS = 1000
+TELEMETRY_DEADBAND = 0.25         # PSI
+TELEMETRY_FLUSH_MS = 30000
+telemetry = TelemetryLog(TELEMETRY_FILE, read_pressure,
+                         max_bytes=TELEMETRY_MAX_BYTES,
+                         sample_ms=TELEMETRY_SAMPLE_MS,
+                         deadband=TELEMETRY_DEADBAND,
+                         flush_ms=TELEMETRY_FLUSH_MS)
+
+HISTORY_MAX_POINTS = 2000  # Upper limit for the max_points parameter
+
+@app.route('/history')
+async def get_history(request):
+    """Pressure history, downsampled on the device and streamed in chunks
+    (see history.py).
+
+    Query parameters: ``since`` (seconds on the telemetry log's clock, as
+    returned in ``start``), ``max_points`` (default 300) and ``format`` (``json`` or
+    ``bin``).
+    """
+    try:
+        since = request.args.get('since')
+        since = int(since) if since else None
+        max_points = int(request.args.get('max_points', 300))
+    except ValueError:
+        return {'status': 'error', 'message': 'Invalid query parameter'}, 400
+    max_points = max(2, min(max_points, HISTORY_MAX_POINTS))
+    binary = request.args.get('format') == 'bin'
+    return Response(body=history.stream(telemetry, since, max_points, binary),
+                    headers={
+        'Content-Type': 'application/octet-stream' if binary else 'application/json',
+        'Cache-Control': 'no-cache',
+    })
+
+# Every run is recorded to flash, and the latest ones are listed at /runs
+RUN_LOG_FILE = 'runs.bin'
+RUN_LOG_MAX_RUNS = 256  # 32 bytes each
+RUN_LOG_INDEX = 20      # Latest runs kept in RAM for /runs
+run_log = runlog.RunLog(RUN_LOG_FILE, max_runs=RUN_LOG_MAX_RUNS,
+                        index_size=RUN_LOG_INDEX)
+
+def record_run(command, outcome, start_s, duration_ms, start_psi, end_psi,
+               pulses, valve_ms):
+    overshoot = max((end_psi - command.target_psi) * command.direction, 0.0)
+    try:
+        run = run_log.record(command.direction, outcome,
+                             command.cancel_source if outcome == runlog.CANCELLED else None,
+                             start_s, duration_ms, start_psi, end_psi,
+                             command.target_psi, overshoot, valve_ms, pulses)
+        print(f"{command.name} run {run}: {runlog.OUTCOMES[outcome]} in {duration_ms / 1000:.1f}s, {pulses} pulses")
+    except OSError as e:
+        print('Error saving run record:', e)
+
+@app.route('/runs')
+def get_runs(request):
+    """Latest runs, newest first. Optional ``command`` (``air_up`` or
+    ``air_down``) and ``limit`` query parameters."""
+    command = controller.commands.get(request.args.get('command'))
+    try:
+        limit = int(request.args.get('limit', RUN_LOG_INDEX))
+    except ValueError:
+        return {'status': 'error', 'message': 'Invalid query parameter'}, 400
+    runs = run_log.runs(limit, command.direction if command else None)
+    for run in runs:
+        run['command'] = 'air_up' if run.pop('direction') > 0 else 'air_down'
+    return {'total': run_log.seq, 'runs': runs}
+
+# Settle detection (see settle.py): a reading is stable once the last 16
+# readings (750ms) fit a line that is both flat and close to them
+SETTLE_PERIOD_MS = 50     # Milliseconds between readings
+SETTLE_WINDOW = 16        # Readings fitted
+SETTLE_MAX_SLOPE = 0.3    # PSI/sec
+SETTLE_MAX_NOISE = 0.25   # PSI, standard deviation around the fitted line
+# Before the window fills, the relaxation after a pulse is extrapolated, and
+# the wait ends early once the settled value is known to within this
+SETTLE_MAX_ERROR = 0.1    # PSI
+settle_detector = SettleDetector(read_pressure, period_ms=SETTLE_PERIOD_MS,
+                                 window=SETTLE_WINDOW,
+                                 max_slope=SETTLE_MAX_SLOPE,
+                                 max_noise=SETTLE_MAX_NOISE,
+                                 max_error=SETTLE_MAX_ERROR)
+
+async def wait_for_stable_pressure(max_wait_time=5.0):
     """Wait for pressure reading to stabilize, returning stable pressure value
-    
+
     Args:
         max_wait_time: Maximum time to wait in seconds
-        stability_threshold: Consider stable if change is less than this in PSI
-        
+
     Returns:
-        Stable pressure reading
+        Stable pressure reading (predicted, if the relaxation could be
+        extrapolated; the latest one if it never settled)
     """
-    start_time = time.time()
-    last_pressure = read_pressure()
-    last_check_time = start_time
-    
-    # Initial reading
-    await asyncio.sleep(0.2)
-    
-    while True:
-        current_time = time.time()
-        elapsed = current_time - start_time
-        
-        # Don't wait longer than max_wait_time
-        if elapsed >= max_wait_time:
-            return read_pressure()
-        
-        # Check every 250ms
-        if current_time - last_check_time >= 0.25:
-            current_pressure = read_pressure()
-            time_diff = current_time - last_check_time
-            pressure_change_rate = abs(current_pressure - last_pressure) / time_diff
-            
-            # If change rate is less than threshold PSI per second, consider stable
-            if pressure_change_rate < stability_threshold:
-                return current_pressure
-            
-            # Update for next check
-            last_pressure = current_pressure
-            last_check_time = current_time
-        
-        # Yield to other tasks briefly
-        await asyncio.sleep(0.1)
+    psi = await settle_detector.wait(int(max_wait_time * 1000))
+    d = settle_detector
+    metrics.pressure_settle.observe(d.settle_ms * 1000)
+    if d.predicted:
+        print(f"Pressure predicted to settle at {psi:.2f} ±{d.bound:.2f} PSI after {d.settle_ms} ms")
+    else:
+        print(f"Pressure {'settled' if d.settled else 'still moving'} at {psi:.2f} PSI after {d.settle_ms} ms (slope {d.slope:+.2f} PSI/s, noise {d.noise:.3f} PSI)")
+    return psi
 
 @app.route('/pressure')
 def get_pressure(request):
     """API endpoint for pressure reading"""
     return {"pressure": round(read_pressure(), 2)}
 
+@app.route('/state')
+def get_state(request):
+    """Everything the UI shows, in one response"""
+    s_onroad, s_offroad = load_setpoints()
+    state = {'pressure': round(read_pressure(), 2)}
+    for cmd, command in controller.commands.items():
+        state[cmd] = {
+            'status': 'running' if command.running else 'idle',
+            'time': round(command.elapsed(), 1),
+            'target_psi': command.target_psi if command.running else None
+        }
+    state['setpoint_onroad'] = s_onroad
+    state['setpoint_offroad'] = s_offroad
+    return state
+
+# Live state stream (Server-Sent Events) so clients hold one connection open
+# instead of polling
+EVENTS_INTERVAL = 0.25   # Seconds between state checks for each client
+EVENTS_KEEPALIVE = 15    # Seconds of no changes before a keep-alive comment
+
+def events_state():
+    """Compact state snapshot sent to /events clients"""
+    state = {'pressure': round(read_pressure(), 1)}
+    for cmd, command in controller.commands.items():
+        state[cmd] = {'status': 'running' if command.running else 'idle',
+                      'time': int(command.elapsed())}
+    return state
+
+@app.route('/events')
+async def events(request):
+    """Server-Sent Events stream, pushing state whenever it changes"""
+    async def stream():
+        last = None
+        quiet = 0
+        while True:
+            seen = state_version
+            data = ujson.dumps(events_state())
+            if data != last:
+                last = data
+                quiet = 0
+                lagmon.mark('/events')
+                yield b'data: ' + data.encode() + b'\n\n'
+            else:
+                quiet += EVENTS_INTERVAL
+                if quiet >= EVENTS_KEEPALIVE:
+                    # Lets us notice clients that went away
+                    quiet = 0
+                    yield b': keep-alive\n\n'
+            await wait_state_change(seen, EVENTS_INTERVAL)
+
+    return Response(body=stream(), headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+
+# WebSocket control channel: clients send commands and get state pushed back
+# on the same connection. Messages are JSON objects with a 'type' field:
+#   {"type": "start" | "cancel" | "status", "cmd": "air_up" | "air_down"}
+#   {"type": "get_setpoints"}
+#   {"type": "set_setpoints", "setpoint_onroad": 32, "setpoint_offroad": 14}
+# Replies carry "type": "reply"; state updates carry "type": "state".
+def ws_dispatch(msg):
+    """Handle one WebSocket command message, returning the reply"""
+    kind = msg.get('type')
+    if kind in ('start', 'cancel', 'status'):
+        cmd = msg.get('cmd')
+        if cmd not in controller.commands:
+            reply = {'status': 'error', 'command': cmd,
+                     'message': f"Unknown command: {cmd}"}
+        else:
+            reply = controller.action(cmd, kind, SOURCE_WEBSOCKET)
+    elif kind == 'get_setpoints':
+        s_onroad, s_offroad = load_setpoints()
+        reply = {'setpoint_onroad': s_onroad, 'setpoint_offroad': s_offroad}
+    elif kind == 'set_setpoints':
+        try:
+            save_setpoints(msg.get('setpoint_onroad'), msg.get('setpoint_offroad'))
+            reply = {'status': 'ok'}
+        except ValueError as e:
+            reply = {'status': 'error', 'message': str(e)}
+    else:
+        reply = {'status': 'error', 'message': f"Unknown message type: {kind}"}
+    reply['type'] = 'reply'
+    reply['request'] = kind
+    return reply
+
+async def ws_push_state(ws):
+    """Send a state message to a WebSocket client whenever state changes"""
+    last = None
+    while True:
+        seen = state_version
+        state = events_state()
+        state['type'] = 'state'
+        data = ujson.dumps(state)
+        if data != last:
+            last = data
+            await ws.send(data)
+        await wait_state_change(seen, EVENTS_INTERVAL)
+
+@app.route('/ws')
+@with_websocket
+async def ws_control(request, ws):
+    """Full-duplex command and telemetry channel"""
+    pusher = asyncio.create_task(ws_push_state(ws))
+    try:
+        while True:
+            try:
+                msg = ujson.loads(await ws.receive())
+                if not isinstance(msg, dict):
+                    raise ValueError('not an object')
+            except ValueError:
+                await ws.send(ujson.dumps({'type': 'reply', 'status': 'error',
+                                           'message': 'Invalid message'}))
+                continue
+            await ws.send(ujson.dumps(ws_dispatch(msg)))
+    finally:
+        pusher.cancel()
+
 # Captive portal redirect for common OS probes
-def captive_portal_page():
+def captive_portal_page(request):
     # Return the same response as the main index route
-    return index(None)
+    return index(request)
 
 @app.route('/generate_204')
 @app.route('/fwlink')
@@ -374,234 +496,235 @@ def captive_portal_page():
 @app.route('/ncsi.txt')
 def captive_redirect(request):
     # Serve the captive portal page directly
-    return captive_portal_page()
+    return captive_portal_page(request)
 
 # Static file routes - Must come BEFORE catch-all route
 @app.route('/style.css')
 def style_css(request):
-    with open('style.css') as f:
-        css = f.read()
-    return Response(body=css, headers={'Content-Type': 'text/css'})
+    return assets.response(request, '/style.css')
 
 @app.route('/script.js')
 def script_js(request):
-    with open('script.js') as f:
-        js = f.read()
-    return Response(body=js, headers={'Content-Type': 'application/javascript'})
+    return assets.response(request, '/script.js')
 
 # Serve icon.png as the iOS home screen icon
 @app.route('/icon.png')
 def icon(request):
-    with open('icon.png', 'rb') as f:
-        icon = f.read()
-    return Response(body=icon, headers={'Content-Type': 'image/png'})
+    return assets.response(request, '/icon.png')
 
 # Serve tire.jpeg as the background
 @app.route('/tire.jpeg')
 def tire(request):
-    with open('tire.jpeg', 'rb') as f:
-        tire = f.read()
-    return Response(body=tire, headers={'Content-Type': 'image/jpeg'})
+    return assets.response(request, '/tire.jpeg')
+
+# Any other files under /static on flash are streamed as-is
+STATIC_DIR = 'static'
+STATIC_MAX_AGE = 3600  # Seconds; these URLs are not versioned
+
+@app.route('/static/<path:path>')
+def static(request, path):
+    return send_static(request, STATIC_DIR, path, max_age=STATIC_MAX_AGE)
 
 # Catch-all: serve the captive portal page for all unknown URLs
 @app.route('/<path:path>')
 def catch_all(request, path):
-    return captive_portal_page()
-
-# Configuration for command execution
-COMMAND_DURATION = 10  # seconds for a command to complete
-last_command_time = {}  # Tracks when commands started (for backward compatibility)
+    return captive_portal_page(request)
 
 # Adaptive pressure control parameters
 PRESSURE_TOLERANCE = 0.3  # PSI tolerance for target pressure
-ADJUSTMENT_INTERVAL = 1.0  # Seconds between adjustments
-MIN_VALVE_TIME = 1.0     # Minimum valve open time (seconds)
+MIN_VALVE_TIME = 0.25    # Minimum valve open time (seconds)
+PROBE_VALVE_TIME = 3.0   # Longest pulse until the flow model is confirmed (seconds)
 MAX_VALVE_TIME_UP = 30.0  # Maximum valve open time for air_up (seconds)
 MAX_VALVE_TIME_DOWN = 60.0  # Maximum valve open time for air_down (seconds)
-LEARNING_RATE = 0.3      # How quickly to adapt (0-1)
-
-async def adjust_pressure(cmd, target_psi):
-    """Adaptive pressure adjustment function that learns system behavior"""
+# Flow model asymptotes (see planner.py): filling approaches the compressor
+# tank pressure; choked venting decays toward absolute zero
+SUPPLY_PSI = 120.0
+VENT_ASYMPTOTE_PSI = -14.7
+# Each planned pulse covers at most this fraction of the remaining distance
+# (and stops at least half the tolerance short of the target), so model
+# error shows up as one more short pulse instead of an overshoot
+MAX_PULSE_FRACTION = 0.8
+# The flow model may have been fitted to another setup (fewer tires on the
+# hose, an emptier tank). Until a pulse of the current run lands within this
+# fraction of the pressure change it predicted (or within the tolerance),
+# pulses are capped at PROBE_VALVE_TIME
+MODEL_CONFIRM_FRACTION = 0.25
+# What the flow models have learned is saved here after every run that moved
+# the pressure, and loaded at boot (see planner.save_models)
+FLOW_MODEL_FILE = 'flow_model.bin'
+
+def plan_valve_time(command, current_psi, confirmed):
+    """Valve open time for the next pulse of a command. Unless ``confirmed``
+    (the model predicted the last pulse of this run), it is no longer than a
+    probe pulse."""
+    remaining = command.target_psi - current_psi
+    shortfall = max(abs(remaining) * (1 - MAX_PULSE_FRACTION),
+                    PRESSURE_TOLERANCE / 2)
+    aim = command.target_psi - command.direction * shortfall
+    valve_time = command.model.pulse_time(current_psi, aim)
+    if valve_time is None:
+        # Nothing learned yet: a conservative probe pulse to fit the model
+        valve_time = PROBE_VALVE_TIME if abs(remaining) >= 1.0 else MIN_VALVE_TIME
+    elif not confirmed:
+        valve_time = min(valve_time, PROBE_VALVE_TIME)
+    return max(MIN_VALVE_TIME, min(command.max_valve_time, valve_time))
+
+def model_confirmed(before, expected, after):
+    """Whether a pulse landed where the flow model said it would"""
+    error = abs(after - expected)
+    return error <= PRESSURE_TOLERANCE or \
+        error <= abs(expected - before) * MODEL_CONFIRM_FRACTION
+
+async def adjust_pressure(command):
+    """Reach the command's target with as few valve pulses as possible.
+
+    Each pulse is planned from the command's flow model, and the settled
+    pressure after it is fed back into the model. The model is kept on the
+    command and saved to flash, so later runs (even after a reboot) start
+    with what earlier ones learned. What was learned may not fit the setup
+    of this run, so pulses stay short until one of them has landed where
+    the model predicted.
+    """
+    cmd = command.name
+    target_psi = command.target_psi
     print(f"Starting pressure adjustment: {cmd} to {target_psi} PSI")
-    
-    # Initialize learning parameters if they don't exist
-    if 'observed_rate' not in command_state[cmd]:
-        command_state[cmd]['observed_rate'] = None
-    if 'last_pressure' not in command_state[cmd]:
-        command_state[cmd]['last_pressure'] = await wait_for_stable_pressure()
-    if 'last_valve_time' not in command_state[cmd]:
-        command_state[cmd]['last_valve_time'] = 0.5  # Start conservative
-    if 'last_action_time' not in command_state[cmd]:
-        command_state[cmd]['last_action_time'] = time.time()
-    
-    # Flag to track if we're in learning mode or execution mode
-    learning_mode = command_state[cmd]['observed_rate'] is None
-    
-    # Continue until cancelled or command_state is marked as not running
-    while command_state[cmd]['running'] and not command_state[cmd]['cancel']:
-        # Get stable pressure reading (important for accurate learning)
-        print("Waiting for pressure to stabilize...")
-        current_psi = await wait_for_stable_pressure(max_wait_time=3.0)
+
+    # Get stable pressure reading (important for accurate learning)
+    start_s = telemetry.now_s()
+    started = time.ticks_ms()
+    print("Waiting for pressure to stabilize...")
+    current_psi = await wait_for_stable_pressure(max_wait_time=3.0)
+    start_psi = current_psi
+    learned = False
+    confirmed = False
+    pulses = 0
+    total_valve_ms = 0
+    outcome = runlog.CANCELLED
+
+    # Continue until cancelled (the controller marks the command as stopped
+    # when this returns)
+    while command.running and not command.cancel:
         pressure_diff = target_psi - current_psi
-        current_time = time.time()
-        
+
         # Check if we've reached or overshot the target
         if abs(pressure_diff) <= PRESSURE_TOLERANCE:
             # Within tolerance - perfect!
             print(f"Target reached: {current_psi:.1f} PSI")
-            command_state[cmd]['running'] = False
+            outcome = runlog.REACHED
             break
-        elif (cmd == 'air_up' and current_psi > target_psi) or \
-             (cmd == 'air_down' and current_psi < target_psi):
+        elif pressure_diff * command.direction < 0:
             # Overshot the target - just stop
             print(f"Target overshot: {current_psi:.1f} PSI (target was {target_psi:.1f})")
-            command_state[cmd]['running'] = False
+            outcome = runlog.OVERSHOT
             break
-            
-        # Check if we should measure the rate of change
-        time_since_last_action = current_time - command_state[cmd]['last_action_time']
-        if time_since_last_action > 1.0 and command_state[cmd]['last_pressure'] > 0:
-            # Calculate rate of change since last action
-            pressure_change = current_psi - command_state[cmd]['last_pressure']
-            rate = pressure_change / time_since_last_action  # PSI per second
-            
-            # If the pressure change is in the expected direction
-            valid_change = (cmd == 'air_up' and pressure_change > 0) or \
-                           (cmd == 'air_down' and pressure_change < 0)
-            
-            if valid_change and abs(rate) > 0.01:  # Ignore tiny changes
-                # Update observed rate with smoothing
-                rate = abs(rate)  # Use absolute value for calculations
-                if command_state[cmd]['observed_rate'] is None:
-                    command_state[cmd]['observed_rate'] = rate
-                    print(f"Initial {cmd} rate: {rate:.3f} PSI/sec")
-                else:
-                    # Apply learning rate for smooth updates
-                    command_state[cmd]['observed_rate'] = (
-                        (1 - LEARNING_RATE) * command_state[cmd]['observed_rate'] + 
-                        LEARNING_RATE * rate
-                    )
-                    print(f"Updated {cmd} rate: {command_state[cmd]['observed_rate']:.3f} PSI/sec")
-        
-        # Determine valve open time based on learning
-        valve_time = 3.0  # Default conservative time
-        
-        # If we've observed a rate, calculate optimal valve time
-        if command_state[cmd]['observed_rate'] is not None and abs(command_state[cmd]['observed_rate']) > 0.01:
-            # Calculate how long to open valve to get close to target
-            # Use 80% of calculated time as a safety factor
-            valve_time = abs(pressure_diff) * 0.8 / command_state[cmd]['observed_rate']
-            
-            # Apply appropriate limits based on operation type
-            if cmd == 'air_down':
-                # Air down typically has lower flow rate
-                valve_time = max(MIN_VALVE_TIME, min(MAX_VALVE_TIME_DOWN, valve_time))
-            else:  # air_up
-                # Air up typically has higher flow rate
-                valve_time = max(MIN_VALVE_TIME, min(MAX_VALVE_TIME_UP, valve_time))
-            
-            # If very close to target, use minimum time
-            if abs(pressure_diff) < 1.0:
-                valve_time = MIN_VALVE_TIME
-        
-        # For air_up: activate fill valve if below target
-        if cmd == 'air_up' and pressure_diff > 0:
-            # Store current state for learning
-            command_state[cmd]['last_pressure'] = current_psi
-            command_state[cmd]['last_action_time'] = current_time
-            command_state[cmd]['last_valve_time'] = valve_time
-            
-            print(f"Adjusting up: {current_psi:.1f} → {target_psi:.1f} PSI (valve: {valve_time:.2f}s)")
-            compressed_air_relay.value(1)  # Open fill valve
-            
-            # Break valve operation into small chunks to check for cancel
-            start_valve_time = time.time()
-            while time.time() - start_valve_time < valve_time:
-                # Check if operation was cancelled
-                if command_state[cmd]['cancel']:
-                    print(f"{cmd} cancelled during valve operation")
-                    break
-                # Sleep in small increments
-                await asyncio.sleep(0.1)
-                
-            compressed_air_relay.value(0)  # Always close fill valve
-            
-            # If cancelled, exit the loop
-            if command_state[cmd]['cancel']:
-                command_state[cmd]['running'] = False
+
+        valve_time = plan_valve_time(command, current_psi, confirmed)
+        expected = command.model.predict(current_psi, valve_time)
+        print(f"Adjusting {'up' if command.direction > 0 else 'down'}: {current_psi:.1f} → {target_psi:.1f} PSI (valve: {valve_time:.2f}s" +
+              (f", expect {expected:.1f} PSI" if expected is not None else "") +
+              ("" if confirmed else ", unconfirmed model") + ")")
+
+        # Time the pulse with ticks_ms; time.time() only has whole seconds
+        # on the ESP32
+        valve_ms = int(valve_time * 1000)
+        command.relay.value(1)  # Open fill or vent valve
+        opened = time.ticks_ms()
+        while True:
+            # Check if operation was cancelled
+            if command.cancel:
+                print(f"{cmd} cancelled during valve operation")
                 break
-        
-        # For air_down: activate vent valve if above target
-        elif cmd == 'air_down' and pressure_diff < 0:
-            # Store current state for learning
-            command_state[cmd]['last_pressure'] = current_psi
-            command_state[cmd]['last_action_time'] = current_time
-            command_state[cmd]['last_valve_time'] = valve_time
-            
-            print(f"Adjusting down: {current_psi:.1f} → {target_psi:.1f} PSI (valve: {valve_time:.2f}s)")
-            vent_air_relay.value(1)  # Open vent valve
-            
-            # Break valve operation into small chunks to check for cancel
-            start_valve_time = time.time()
-            while time.time() - start_valve_time < valve_time:
-                # Check if operation was cancelled
-                if command_state[cmd]['cancel']:
-                    print(f"{cmd} cancelled during valve operation")
-                    break
-                # Sleep in small increments
-                await asyncio.sleep(0.1)
-                
-            vent_air_relay.value(0)  # Always close vent valve
-            
-            # If cancelled, exit the loop
-            if command_state[cmd]['cancel']:
-                command_state[cmd]['running'] = False
+            remaining_ms = valve_ms - time.ticks_diff(time.ticks_ms(), opened)
+            if remaining_ms <= 0:
                 break
-        
-        # No additional waiting needed - the wait_for_stable_pressure call
-        # at the beginning of the loop already ensures adequate settling time
+            # Sleep in small increments
+            lagmon.mark('adjust_pressure')
+            await asyncio.sleep_ms(min(remaining_ms, 100))
+        command.relay.value(0)  # Always close the valve
+        open_ms = time.ticks_diff(time.ticks_ms(), opened)
+        open_time = open_ms / 1000
+        pulses += 1
+        total_valve_ms += open_ms
+        metrics.valve_pulse('fill' if command.direction > 0 else 'vent', open_ms)
+        lag_monitor.valve_pulse(valve_ms, open_ms)
+
+        # If cancelled, exit the loop
+        if command.cancel:
+            break
 
-async def check_command_status():
-    """Background task that monitors command state"""
-    while True:
-        current_time = time.time()
-        
-        # Check both commands
-        for cmd in ['air_up', 'air_down']:
-            # Check if command is running
-            is_running = command_state[cmd]['running']
-            
-            # Safely access start_time
-            start_time = 0
-            if 'start_time' in command_state[cmd]:
-                start_time = command_state[cmd]['start_time']
-                
-            has_start_time = cmd in last_command_time or start_time > 0
-            
-            if is_running and has_start_time:
-                # Calculate elapsed time (for status reporting only)
-                start_time = 0
-                if 'start_time' in command_state[cmd]:
-                    start_time = command_state[cmd]['start_time']
-                    
-                # Fall back to legacy timing if needed
-                if start_time == 0 and cmd in last_command_time:
-                    start_time = last_command_time[cmd]
-                
-                # Calculate elapsed time (for status API)
-                elapsed = current_time - start_time
-                # No logging here - removing periodic status updates
-
-        # Check once per second
-        await asyncio.sleep(1)
+        # Let the manifold and tires equalize, then learn from the pulse
+        print("Waiting for pressure to stabilize...")
+        new_psi = await wait_for_stable_pressure(max_wait_time=3.0)
+        fitted = command.model.observe(current_psi, new_psi, open_time)
+        if fitted:
+            learned = True
+            band = command.model.band((current_psi + new_psi) / 2)
+            print(f"{cmd} flow model: k={command.model.band_rate(band):.5f}/s after {command.model.pulses[band]} pulses in band {band}")
+        if expected is None:
+            # A model with nothing learned is now fitted to this run alone
+            confirmed = fitted
+        else:
+            confirmed = model_confirmed(current_psi, expected, new_psi)
+        current_psi = new_psi
+
+    if learned:
+        save_flow_models()
+    if outcome == runlog.CANCELLED:
+        # The valve may have just closed; give the reading a moment (usually
+        # an extrapolated few hundred ms) so the record shows where it ended
+        current_psi = await wait_for_stable_pressure(max_wait_time=1.0)
+    record_run(command, outcome, start_s, time.ticks_diff(time.ticks_ms(), started),
+               start_psi, current_psi, pulses, total_valve_ms)
+    lagmon.mark('adjust_pressure')
+
+# Both commands go through one controller, which only lets one of them run at
+# a time and tells streaming clients whenever one starts or stops
+def command_target(command):
+    """Air up goes to the on-road setpoint, air down to the off-road one"""
+    s_onroad, s_offroad = load_setpoints()
+    return s_onroad if command.direction > 0 else s_offroad
+
+# Saved in this order; changing it (or the band layout) needs a new
+# planner.MODEL_VERSION
+flow_models = (FlowModel(SUPPLY_PSI), FlowModel(VENT_ASYMPTOTE_PSI))
+# The saved models may have been fitted to another setup. They only count as
+# one pulse each, and like any model they don't plan pulses longer than
+# PROBE_VALVE_TIME until a pulse of the run confirms them (see
+# adjust_pressure)
+if load_models(FLOW_MODEL_FILE, flow_models):
+    print('Loaded flow models from', FLOW_MODEL_FILE)
+
+def save_flow_models():
+    try:
+        save_models(FLOW_MODEL_FILE, flow_models)
+    except OSError as e:
+        # Not fatal: the models are still in RAM, and the next run retries
+        print('Error saving flow models:', e)
+
+controller = CommandController(
+    [PressureCommand('air_up', 'Air up', 1, compressed_air_relay,
+                     MAX_VALVE_TIME_UP, flow_models[0]),
+     PressureCommand('air_down', 'Air down', -1, vent_air_relay,
+                     MAX_VALVE_TIME_DOWN, flow_models[1])],
+    run=adjust_pressure, target=command_target, on_change=notify_state)
 
 # Run the app (non-blocking, with asyncio)
 async def main():
     print('Starting Microdot server (asyncio mode)...')
-    # Start the command status checker in the background
-    asyncio.create_task(check_command_status())
-    # Start the button monitor in the background
-    asyncio.create_task(monitor_buttons())
+    # Start sampling the pressure sensor in the background
+    asyncio.create_task(pressure_sampler.run())
+    # Watch for anything holding up the event loop
+    asyncio.create_task(lag_monitor.run())
+    # Write setpoint changes back to flash
+    asyncio.create_task(setpoints.run())
+    # Record the pressure history
+    asyncio.create_task(telemetry.run())
+    # Start the button handlers in the background; they sleep until a pin
+    # interrupt wakes them
+    air_up_button = Button(AIR_UP_BUTTON_PIN)
+    air_down_button = Button(AIR_DOWN_BUTTON_PIN)
+    asyncio.create_task(air_up_button.run(lambda g: button_gesture('air_up', g)))
+    asyncio.create_task(air_down_button.run(lambda g: button_gesture('air_down', g)))
     # Start the server
     await app.start_server(host='0.0.0.0', port=80)
 
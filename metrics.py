@@ -0,0 +1,191 @@
+# metrics.py - Request and control loop counters in the Prometheus text format
+
+import time
+from array import array
+
+import lagmon
+
+try:
+    import gc
+except ImportError:  # pragma: no cover
+    gc = None
+
+# Histogram bucket upper bounds, in microseconds
+REQUEST_BUCKETS_US = (5000, 10000, 25000, 50000, 100000, 250000, 500000,
+                      1000000, 2500000, 10000000)
+READ_BUCKETS_US = (10, 25, 50, 100, 250, 500, 1000, 5000)
+SETTLE_BUCKETS_US = (250000, 500000, 750000, 1000000, 1500000, 2000000,
+                     3000000, 5000000)
+COLLECT_BUCKETS_US = (1000, 2500, 5000, 10000, 25000, 50000, 100000)
+# Heap allocation histogram bucket upper bounds, in bytes
+ALLOC_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+class Histogram:
+    """Counts of observations per bucket, in an array. Observations are in
+    microseconds, rendered as seconds, unless ``seconds`` is false.
+
+    Observing costs a short scan over the bucket bounds and two additions;
+    the cumulative counts Prometheus wants are only worked out when
+    rendered.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'format')
+
+    def __init__(self, bounds, seconds=True):
+        self.bounds = bounds
+        self.counts = array('I', [0] * (len(bounds) + 1))  # last is +Inf
+        self.sum = 0
+        self.format = _seconds if seconds else str
+
+    def observe(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def render(self, name, labels=''):
+        sep = ',' if labels else ''
+        total = 0
+        for i, bound in enumerate(self.bounds):
+            total += self.counts[i]
+            yield '%s_bucket{%s%sle="%s"} %d\n' % (
+                name, labels, sep, self.format(bound), total)
+        total += self.counts[-1]
+        yield '%s_bucket{%s%sle="+Inf"} %d\n' % (name, labels, sep, total)
+        braces = '{' + labels + '}' if labels else ''
+        yield '%s_sum%s %s\n' % (name, braces, self.format(self.sum))
+        yield '%s_count%s %d\n' % (name, braces, total)
+
+
+def _seconds(us):
+    return '%d.%06d' % (us // 1000000, us % 1000000)
+
+
+class Metrics:
+    """Collects the numbers served at ``/metrics``.
+
+    Set as ``app.metrics`` it is told about every connection and request by
+    Microdot (see :attr:`microdot.Microdot.metrics`), including the bytes
+    each request allocated and the garbage collections run between them
+    when Microdot measures those. The control loop
+    reports pressure reads, settle waits and valve pulses through
+    :attr:`pressure_read`, :attr:`pressure_settle` and :meth:`valve_pulse`.
+
+    Recording only updates counters; all formatting happens in
+    :meth:`render`, when the endpoint is scraped.
+    """
+
+    def __init__(self):
+        self.requests = {}      # (route, status) -> count
+        self.latency = {}       # route -> Histogram
+        self.connections = 0
+        self.connections_total = 0
+        self.pressure_read = Histogram(READ_BUCKETS_US)
+        self.pressure_settle = Histogram(SETTLE_BUCKETS_US)
+        self.valve_ms = {}      # valve -> ms open
+        self.valve_pulses = {}  # valve -> pulses
+        self.allocated = {}     # route -> Histogram of bytes allocated
+        self.over_budget = {}   # route -> requests over the alloc budget
+        self.heap_collect = Histogram(COLLECT_BUCKETS_US)
+
+    # Microdot hooks
+    def connection_opened(self):
+        self.connections += 1
+        self.connections_total += 1
+
+    def connection_closed(self):
+        self.connections -= 1
+
+    def request_started(self):
+        return time.ticks_us()
+
+    def request_done(self, req, res, started, allocated=None):
+        us = time.ticks_diff(time.ticks_us(), started)
+        if req is None:
+            route = 'invalid'
+        else:
+            route = req.url_rule or 'unmatched'
+        key = (route, res.status_code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.latency.get(route)
+        if histogram is None:
+            histogram = self.latency[route] = Histogram(REQUEST_BUCKETS_US)
+        histogram.observe(us)
+        if allocated is not None:
+            histogram = self.allocated.get(route)
+            if histogram is None:
+                histogram = self.allocated[route] = Histogram(ALLOC_BUCKETS,
+                                                              seconds=False)
+            histogram.observe(allocated)
+            if allocated > req.app.alloc_budget:
+                self.over_budget[route] = self.over_budget.get(route, 0) + 1
+        lagmon.mark(route)
+
+    def heap_collected(self, us):
+        self.heap_collect.observe(us)
+
+    def valve_pulse(self, valve, ms):
+        self.valve_ms[valve] = self.valve_ms.get(valve, 0) + ms
+        self.valve_pulses[valve] = self.valve_pulses.get(valve, 0) + 1
+
+    def render(self):
+        """Generate the metrics in the Prometheus text format, a few lines
+        at a time. Requests served while the output is being sent may add
+        entries, so every dict is copied before it is walked."""
+        yield '# TYPE http_requests_total counter\n'
+        for (route, status), count in list(self.requests.items()):
+            yield 'http_requests_total{route="%s",status="%d"} %d\n' % (
+                route, status, count)
+        yield '# TYPE http_request_duration_seconds histogram\n'
+        for route, histogram in list(self.latency.items()):
+            yield from histogram.render('http_request_duration_seconds',
+                                        'route="%s"' % route)
+        yield '# TYPE http_connections_active gauge\n'
+        yield 'http_connections_active %d\n' % self.connections
+        yield '# TYPE http_connections_total counter\n'
+        yield 'http_connections_total %d\n' % self.connections_total
+        yield '# TYPE pressure_read_duration_seconds histogram\n'
+        yield from self.pressure_read.render('pressure_read_duration_seconds')
+        yield '# TYPE pressure_settle_duration_seconds histogram\n'
+        yield from self.pressure_settle.render(
+            'pressure_settle_duration_seconds')
+        yield '# TYPE valve_open_seconds_total counter\n'
+        for valve, ms in list(self.valve_ms.items()):
+            yield 'valve_open_seconds_total{valve="%s"} %d.%03d\n' % (
+                valve, ms // 1000, ms % 1000)
+        yield '# TYPE valve_pulses_total counter\n'
+        for valve, pulses in list(self.valve_pulses.items()):
+            yield 'valve_pulses_total{valve="%s"} %d\n' % (valve, pulses)
+        yield '# TYPE http_request_allocated_bytes histogram\n'
+        for route, histogram in list(self.allocated.items()):
+            yield from histogram.render('http_request_allocated_bytes',
+                                        'route="%s"' % route)
+        yield '# TYPE http_requests_over_budget_total counter\n'
+        for route, count in list(self.over_budget.items()):
+            yield 'http_requests_over_budget_total{route="%s"} %d\n' % (
+                route, count)
+        yield '# TYPE heap_collect_duration_seconds histogram\n'
+        yield from self.heap_collect.render('heap_collect_duration_seconds')
+        if gc is not None and hasattr(gc, 'mem_free'):
+            yield '# TYPE heap_free_bytes gauge\n'
+            yield 'heap_free_bytes %d\n' % gc.mem_free()
+            yield '# TYPE heap_allocated_bytes gauge\n'
+            yield 'heap_allocated_bytes %d\n' % gc.mem_alloc()
+
+    def chunks(self, size=1024):
+        """:meth:`render` grouped into chunks of about ``size`` bytes, so a
+        response body doesn't cost a socket write per line."""
+        lines = []
+        length = 0
+        for line in self.render():
+            lines.append(line)
+            length += len(line)
+            if length >= size:
+                yield ''.join(lines)
+                lines = []
+                length = 0
+        if lines:
+            yield ''.join(lines)
@@ -6,6 +6,7 @@ The ``microdot`` module defines a few classes that help implement HTTP-based
 servers for MicroPython and standard Python.
 """
 import asyncio
+import gc
 import io
 import re
 import time
@@ -61,6 +62,14 @@ MUTED_SOCKET_ERRORS = [
 ]
 
 
+def heap_allocated():
+    """Return the number of bytes allocated on the heap, or ``None`` where
+    this isn't known (it is only available in MicroPython)."""
+    if hasattr(gc, 'mem_alloc'):
+        return gc.mem_alloc()
+    return None
+
+
 def urldecode(s):
     if isinstance(s, str):
         s = s.encode()
@@ -117,6 +126,9 @@ class NoCaseDict(dict):
         super().__setitem__(key, value)
 
     def __getitem__(self, key):
+        if key in self.keys():
+            # looked up with the same case it was stored with
+            return super().__getitem__(key)
         kl = key.lower()
         return super().__getitem__(self.keymap.get(kl, kl))
 
@@ -125,10 +137,14 @@ class NoCaseDict(dict):
         super().__delitem__(self.keymap.get(kl, kl))
 
     def __contains__(self, key):
+        if key in self.keys():
+            return True
         kl = key.lower()
         return self.keymap.get(kl, kl) in self.keys()
 
     def get(self, key, default=None):
+        if key in self.keys():
+            return super().get(key)
         kl = key.lower()
         return super().get(self.keymap.get(kl, kl), default)
 
@@ -285,6 +301,152 @@ class AsyncBytesIO:
         pass
 
 
+class Pool:
+    """Objects kept for reuse, so that they don't need to be allocated again.
+
+    :param size: The maximum number of objects kept.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.free = []
+        #: The number of times an object was taken from the pool.
+        self.hits = 0
+        #: The number of times the pool was empty.
+        self.misses = 0
+
+    def get(self):
+        """Take an object from the pool, or return ``None`` if it is empty."""
+        if self.free:
+            self.hits += 1
+            return self.free.pop()
+        self.misses += 1
+        return None
+
+    def put(self, obj):
+        """Return an object to the pool. It is dropped if the pool is full."""
+        if len(self.free) < self.size:
+            self.free.append(obj)
+
+
+class BufferedStream:
+    """A read buffer in front of a connection's input stream.
+
+    The request header block is read in bulk with :meth:`read_head`. Bytes
+    received past the end of it are kept and returned first by the other
+    read methods, as the start of the request body or of the next request on
+    a persistent connection.
+
+    :param stream: The input stream.
+    :param buf: The ``bytearray`` to receive data into, which can be reused
+                from one connection to the next. One of ``read_size`` bytes
+                is allocated if not given. A header block that doesn't fit
+                is received into a larger one, allocated for the rest of the
+                connection.
+    """
+    #: The number of bytes requested from the stream on each read.
+    read_size = 1024
+
+    def __init__(self, stream, buf=None):
+        self.stream = stream
+        self.buf = buf if buf is not None else bytearray(self.read_size)
+        # the bytes received but not read yet are buf[start:end]
+        self.start = 0
+        self.end = 0
+
+    async def _receive(self):
+        """Receive more data into the buffer after the unread bytes, and
+        return the number of bytes received (0 when the stream has ended)."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            # move the unread bytes to the front, into a larger buffer if
+            # they fill this one
+            n = self.end - self.start
+            buf = self.buf if n < len(self.buf) else bytearray(2 * n)
+            buf[:n] = bytes(memoryview(self.buf)[self.start:self.end])
+            self.buf = buf
+            self.start = 0
+            self.end = n
+        view = memoryview(self.buf)[self.end:]
+        if hasattr(self.stream, 'readinto'):
+            n = await self.stream.readinto(view) or 0
+        else:
+            data = await self.stream.read(len(view))
+            n = len(data)
+            view[:n] = data
+        self.end += n
+        return n
+
+    def _take(self, n):
+        """Return up to ``n`` unread bytes (all of them if ``n`` is
+        negative), as ``bytes``."""
+        if n < 0 or n > self.end - self.start:
+            n = self.end - self.start
+        data = bytes(memoryview(self.buf)[self.start:self.start + n])
+        self.start += n
+        return data
+
+    async def read_head(self, max_length):
+        """Read up to and including the blank line that ends a header block,
+        and return the block without it, decoded. Returns whatever was
+        received if the stream ends first, which is ``''`` for a connection
+        closed between requests.
+
+        :param max_length: The maximum length of the header block. A
+                           ``ValueError`` is raised if no blank line is found
+                           within this many bytes.
+        """
+        searched = 0
+        while True:
+            scan = self.start + searched
+            if self.end > scan:
+                # only the bytes not searched yet are copied, and the first
+                # separator in them ends the block
+                data = bytes(memoryview(self.buf)[scan:self.end])
+                end = data.find(b'\r\n\r\n')
+                sep = 4
+                lf = data.find(b'\n\n', 0, end if end >= 0 else len(data))
+                if lf >= 0:
+                    end = lf
+                    sep = 2
+                if end >= 0:
+                    head = str(memoryview(self.buf)[self.start:scan + end],
+                               'utf-8')
+                    self.start = scan + end + sep
+                    return head
+            length = self.end - self.start
+            if length > max_length:
+                raise ValueError('request header too long')
+            # the separator may straddle the previous read
+            searched = max(length - 3, 0)
+            if not await self._receive():
+                return str(self._take(-1), 'utf-8')
+
+    async def read(self, n=-1):
+        if self.end > self.start:
+            return self._take(n)
+        return await self.stream.read(n)
+
+    async def readexactly(self, n):
+        data = b''
+        if self.end > self.start:
+            data = self._take(n)
+            if len(data) == n:
+                return data
+        return data + await self.stream.readexactly(n - len(data))
+
+    async def readline(self):
+        if self.end > self.start:
+            data = bytes(memoryview(self.buf)[self.start:self.end])
+            end = data.find(b'\n')
+            if end >= 0:
+                self.start += end + 1
+                return data[:end + 1]
+            self.start = self.end
+            return data + await self.stream.readline()
+        return await self.stream.readline()
+
+
 class Request:
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -316,6 +478,14 @@ class Request:
     #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
     max_readline = 2 * 1024
 
+    #: Specify the maximum length allowed for the request line and headers
+    #: together. Requests with a longer header block are rejected.
+    #:
+    #: Example::
+    #:
+    #:    Request.max_header_length = 16 * 1024  # 16KB of headers allowed
+    max_header_length = 8 * 1024
+
     class G:
         pass
 
@@ -354,6 +524,17 @@ class Request:
         #: A general purpose container for applications to store data during
         #: the life of the request.
         self.g = Request.G()
+        #: The URL pattern of the route that handles the request, or ``None``
+        #: if no route matched.
+        self.url_rule = None
+        #: The number of bytes allocated on the heap when the request was
+        #: received, if allocations are being measured (see
+        #: :attr:`Microdot.alloc_budget`).
+        self.heap_start = None
+        #: Whether the request counts as in progress, which holds off the
+        #: garbage collection scheduled between requests (see
+        #: :meth:`Microdot.long_lived`).
+        self.in_progress = False
 
         self.http_version = http_version
         if '?' in self.path:
@@ -389,29 +570,39 @@ class Request:
                               written.
         :param client_addr: The address of the client, as a tuple.
 
-        This method is a coroutine. It returns a newly created ``Request``
-        object.
+        This method is a coroutine. It returns a ``Request`` object, taken
+        from the application's request pool if it has one.
         """
-        # request line
-        line = (await Request._safe_readline(client_reader)).strip().decode()
+        if not isinstance(client_reader, BufferedStream):
+            client_reader = BufferedStream(client_reader)
+
+        # request line and headers, received with as few reads as possible
+        # and parsed from a single buffer
+        head = await client_reader.read_head(Request.max_header_length)
+        # the allocations made for the request are counted from here, so the
+        # wait for it isn't
+        heap_start = heap_allocated() if app.alloc_budget is not None \
+            else None
+        lines = head.split('\n')
+        if len(head) > Request.max_readline:
+            for line in lines:
+                if len(line) > Request.max_readline:
+                    raise ValueError('line too long')
+        line = lines[0].strip()
         if not line:  # pragma: no cover
             return None
         method, url, http_version = line.split()
         http_version = http_version.split('/', 1)[1]
 
-        # headers
+        # headers, with each name lowercased just once for the case
+        # insensitive lookup map
         headers = NoCaseDict()
-        content_length = 0
-        while True:
-            line = (await Request._safe_readline(
-                client_reader)).strip().decode()
-            if line == '':
-                break
-            header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-            if header.lower() == 'content-length':
-                content_length = int(value)
+        for line in lines[1:]:
+            line = line.strip()
+            if line:
+                header, value = line.split(':', 1)
+                headers[header] = value.strip()
+        content_length = int(headers.get('Content-Length', 0))
 
         # body
         body = b''
@@ -422,9 +613,16 @@ class Request:
             body = b''
             stream = client_reader
 
-        return Request(app, client_addr, method, url, http_version, headers,
-                       body=body, stream=stream,
-                       sock=(client_reader, client_writer))
+        sock = (client_reader, client_writer)
+        req = app.request_pool.get() if app.request_pool else None
+        if req is None:
+            req = Request(app, client_addr, method, url, http_version,
+                          headers, body=body, stream=stream, sock=sock)
+        else:
+            req.__init__(app, client_addr, method, url, http_version,
+                         headers, body=body, stream=stream, sock=sock)
+        req.heap_start = heap_start
+        return req
 
     def _parse_urlencoded(self, urlencoded):
         data = MultiDict()
@@ -549,6 +747,7 @@ class Response:
         'css': 'text/css',
         'gif': 'image/gif',
         'html': 'text/html',
+        'jpeg': 'image/jpeg',
         'jpg': 'image/jpeg',
         'js': 'application/javascript',
         'json': 'application/json',
@@ -556,8 +755,16 @@ class Response:
         'txt': 'text/plain',
     }
 
+    #: The size of the buffer used to stream file bodies. A single buffer of
+    #: this size is allocated for each response and reused for every read.
     send_file_buffer_size = 1024
 
+    #: Responses whose headers and body (or first chunk of a file body) fit
+    #: in this many bytes are sent with a single write, which lets them go
+    #: out in one TCP segment. The default is the TCP maximum segment size
+    #: used by the ESP32 network stack.
+    coalesce_size = 1436
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -586,6 +793,10 @@ class Response:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        self.http_version = '1.0'
+        # set for responses from Microdot.make_response(), which go back to
+        # the response pool once sent
+        self._pooled = False
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False,
@@ -646,28 +857,64 @@ class Response:
             if 'charset=' not in self.headers['Content-Type']:
                 self.headers['Content-Type'] += '; charset=UTF-8'
 
-    async def write(self, stream):
+    async def write(self, stream, buf=None):
+        """Send the response.
+
+        :param stream: The output stream.
+        :param buf: A ``bytearray`` to assemble the headers and the first
+                    chunk of the body in, instead of allocating one, when
+                    they are sent together.
+        """
         self.complete()
 
         try:
-            # status code
+            # status line and headers, encoded together
             reason = self.reason if self.reason is not None else \
                 ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
-
-            # headers
+            head = ['HTTP/', self.http_version, ' ', str(self.status_code),
+                    ' ', reason, '\r\n']
             for header, value in self.headers.items():
                 values = value if isinstance(value, list) else [value]
                 for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
-                        header=header, value=value).encode())
-            await stream.awrite(b'\r\n')
-
-            # body
+                    head.extend((header, ': ', str(value), '\r\n'))
+            head.append('\r\n')
+            head = ''.join(head).encode()
+
+            # bytes and file bodies have their first chunk available right
+            # away, so it can be sent together with the headers; generators
+            # may take a while to produce one, so the headers go out first
+            iter = None
+            first = None
             if not self.is_head:
-                iter = self.body_iter()
-                async for body in iter:
+                iter = self.body_iter().__aiter__()
+                if not hasattr(self.body, '__anext__') and \
+                        not hasattr(self.body, '__next__'):
+                    try:
+                        first = await iter.__anext__()
+                    except StopAsyncIteration:
+                        iter = None
+                    if isinstance(first, str):  # pragma: no cover
+                        first = first.encode()
+            if first is not None and \
+                    len(head) + len(first) <= self.coalesce_size:
+                n = len(head) + len(first)
+                if buf is None or len(buf) < n:
+                    buf = bytearray(n)
+                buf[:len(head)] = head
+                buf[len(head):n] = first
+                await stream.awrite(memoryview(buf)[:n])
+            else:
+                await stream.awrite(head)
+                if first:
+                    await stream.awrite(first)
+
+            # rest of the body
+            if iter is not None:
+                while True:
+                    try:
+                        body = await iter.__anext__()
+                    except StopAsyncIteration:
+                        break
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
                     try:
@@ -706,6 +953,7 @@ class Response:
                     self.i = self.ITER_UNKNOWN  # need to determine type
                 else:
                     self.i = self.ITER_NO_BODY
+                self.buf = None
                 return self
 
             async def __anext__(self):
@@ -715,6 +963,10 @@ class Response:
                 if self.i == self.ITER_UNKNOWN:
                     if hasattr(response.body, 'read'):
                         self.i = self.ITER_FILE_OBJ
+                        if hasattr(response.body, 'readinto'):
+                            # read the whole file through a single buffer
+                            self.buf = memoryview(bytearray(
+                                response.send_file_buffer_size))
                     elif hasattr(response.body, '__next__'):
                         self.i = self.ITER_SYNC_GEN
                         return next(response.body)
@@ -727,6 +979,13 @@ class Response:
                     except StopIteration:
                         await self.aclose()
                         raise StopAsyncIteration
+                if self.buf is not None:
+                    n = response.body.readinto(self.buf)
+                    if iscoroutine(n):  # pragma: no cover
+                        n = await n
+                    if n < response.send_file_buffer_size:
+                        self.i = self.ITER_NO_BODY
+                    return self.buf[:n]
                 buf = response.body.read(response.send_file_buffer_size)
                 if iscoroutine(buf):  # pragma: no cover
                     buf = await buf
@@ -809,7 +1068,14 @@ class Response:
             headers['Content-Encoding'] = compressed \
                 if isinstance(compressed, str) else 'gzip'
 
-        f = stream or open(filename + file_extension, 'rb')
+        if stream is None:
+            f = open(filename + file_extension, 'rb')
+            # with a known length the connection does not need to be closed
+            # to signal the end of the response
+            headers['Content-Length'] = str(f.seek(0, 2))
+            f.seek(0)
+        else:
+            f = stream
         return cls(body=f, status_code=status_code, headers=headers)
 
 
@@ -827,13 +1093,21 @@ class URLPattern():
         self.url_pattern = url_pattern
         self.segments = []
         self.regex = None
+        #: The normalized path for patterns without dynamic components, which
+        #: are matched by string comparison instead of a regular expression.
+        #: ``None`` for dynamic patterns.
+        self.path = None
+        self.compile()
 
     def compile(self):
         pattern = ''
+        dynamic = False
+        self.segments = []
         for segment in self.url_pattern.lstrip('/').split('/'):
             if segment and segment[0] == '<':
                 if segment[-1] != '>':
                     raise ValueError('invalid URL pattern')
+                dynamic = True
                 segment = segment[1:-1]
                 if ':' in segment:
                     type_, name = segment.rsplit(':', 1)
@@ -853,7 +1127,10 @@ class URLPattern():
             else:
                 pattern += '/' + segment
                 self.segments.append({'parser': None})
-        self.regex = re.compile('^' + pattern + '$')
+        if dynamic:
+            self.regex = re.compile('^' + pattern + '$')
+        else:
+            self.path = pattern
         return self.regex
 
     @classmethod
@@ -862,8 +1139,10 @@ class URLPattern():
         cls.segment_parsers[type_name] = parser
 
     def match(self, path):
+        if self.path is not None:
+            return {} if path == self.path else None
         args = {}
-        g = (self.regex or self.compile()).match(path)
+        g = self.regex.match(path)
         if not g:
             return
         i = 1
@@ -916,6 +1195,46 @@ class Microdot:
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
+        #: The number of seconds an idle persistent (keep-alive) connection
+        #: is kept open waiting for the next request. Set to 0 to close the
+        #: connection after every response.
+        self.keep_alive_timeout = 5
+        #: The maximum number of requests served on a single persistent
+        #: connection before it is closed.
+        self.max_keep_alive_requests = 20
+        self.static_routes = {}
+        self.dynamic_routes = []
+        self.indexed_routes = 0
+        #: An optional object that is told about connections and requests,
+        #: for example to collect metrics. It must implement
+        #: ``connection_opened()``, ``connection_closed()``,
+        #: ``request_started()`` (returning a value that is passed back),
+        #: ``request_done(req, res, started, allocated)`` and
+        #: ``heap_collected(us)``. ``allocated`` is the number of bytes the
+        #: request allocated, or ``None`` if it wasn't measured. These calls
+        #: are made for every request, so they should only update counters.
+        self.metrics = None
+        #: The number of connection buffers, requests and responses kept for
+        #: reuse, so serving a request allocates less. With the default of
+        #: 0 they are allocated for every connection and request. Handlers
+        #: must not keep a reference to a request or a response once it has
+        #: been sent when this is set.
+        self.pool_size = 0
+        #: When set, the garbage collector is run between requests, at a
+        #: time no other request is in progress, once this many bytes have
+        #: been allocated since it last ran there. The heap is then rarely
+        #: found full, and collected, in the middle of a request.
+        self.collect_threshold = None
+        #: When set, the number of bytes allocated while handling each
+        #: request is measured and passed to :attr:`metrics`, which can
+        #: count the requests that allocate more than this. Only available
+        #: in MicroPython.
+        self.alloc_budget = None
+        self.request_pool = None
+        self.response_pool = None
+        self.buffer_pool = None
+        self.requests_in_progress = 0
+        self.collected_heap = 0
 
     def route(self, url_pattern, methods=None):
         """Decorator that is used to register a function as a request handler
@@ -1224,7 +1543,15 @@ class Microdot:
                 writer.awrite = MethodType(awrite, writer)
                 writer.aclose = MethodType(aclose, writer)
 
-            await self.handle_request(reader, writer)
+            metrics = self.metrics
+            if metrics is None:
+                await self.handle_request(reader, writer)
+                return
+            metrics.connection_opened()
+            try:
+                await self.handle_request(reader, writer)
+            finally:
+                metrics.connection_closed()
 
         if self.debug:  # pragma: no cover
             print('Starting async server on {host}:{port}...'.format(
@@ -1299,26 +1626,64 @@ class Microdot:
         """
         self.server.close()
 
+    def index_routes(self):
+        """Split the URL map into a dictionary of static paths and a list of
+        dynamic patterns, so that :meth:`find_route` only needs to run
+        regular expressions for the dynamic routes. Both hold indexes into
+        ``url_map``, which keeps the order routes were registered in. The
+        index is rebuilt whenever routes have been added."""
+        self.static_routes = {}
+        self.dynamic_routes = []
+        for i, route in enumerate(self.url_map):
+            path = route[1].path
+            if path is None:
+                self.dynamic_routes.append(i)
+            elif path in self.static_routes:
+                self.static_routes[path].append(i)
+            else:
+                self.static_routes[path] = [i]
+        self.indexed_routes = len(self.url_map)
+
     def find_route(self, req):
         method = req.method.upper()
         if method == 'OPTIONS' and self.options_handler:
             return self.options_handler(req), '', None
         if method == 'HEAD':
             method = 'GET'
+        if self.indexed_routes != len(self.url_map):
+            self.index_routes()
         f = 404
         p = ''
         s = None
-        for route_methods, route_pattern, route_handler, url_prefix, subapp \
-                in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                p = url_prefix
-                s = subapp
-                if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        req.url_args = None
+        # Walk the static routes for this path and the dynamic routes merged
+        # in registration order, so the first matching route still wins
+        static = self.static_routes.get(req.path, ())
+        dynamic = self.dynamic_routes
+        i = j = 0
+        while i < len(static) or j < len(dynamic):
+            if j == len(dynamic) or (i < len(static) and
+                                     static[i] < dynamic[j]):
+                route_methods, route_pattern, route_handler, url_prefix, \
+                    subapp = self.url_map[static[i]]
+                url_args = {}
+                i += 1
+            else:
+                route_methods, route_pattern, route_handler, url_prefix, \
+                    subapp = self.url_map[dynamic[j]]
+                url_args = route_pattern.match(req.path)
+                j += 1
+                if url_args is None:
+                    continue
+            req.url_args = url_args
+            p = url_prefix
+            s = subapp
+            if method in route_methods:
+                f = route_handler
+                req.url_rule = route_pattern.url_pattern
+                break
+            else:
+                f = 405
         return f, p, s
 
     def default_options_handler(self, req):
@@ -1332,27 +1697,193 @@ class Microdot:
         return {'Allow': ', '.join(allow)}
 
     async def handle_request(self, reader, writer):
-        req = None
+        buffers = None
+        if self.pool_size:
+            if self.buffer_pool is None:
+                self.create_pools()
+            buffers = self.buffer_pool.get() or (
+                bytearray(BufferedStream.read_size),
+                bytearray(Response.coalesce_size))
+        # bytes read past the end of one request belong to the next one, so
+        # the same buffer is used for every request on the connection
+        stream = BufferedStream(reader, buffers[0] if buffers else None)
+        requests = 0
         try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
+            while True:
+                keep_alive = await self.handle_one_request(
+                    stream, writer, requests, buffers[1] if buffers else None)
+                self.collect_garbage()
+                if not keep_alive:
+                    break
+                requests += 1
+        finally:
+            if buffers:
+                self.buffer_pool.put(buffers)
         try:
-            if res != Response.already_handled:  # pragma: no branch
-                await res.write(writer)
             await writer.aclose()
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS:
                 pass
             else:
                 raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    async def handle_one_request(self, reader, writer, requests, buf):
+        """Read, dispatch and answer one request of a connection. Returns
+        whether the connection can be used for another request."""
+        req = None
+        try:
+            if requests == 0:
+                req = await Request.create(
+                    self, reader, writer,
+                    writer.get_extra_info('peername'))
+            else:
+                # wait for the next request on a persistent connection
+                req = await asyncio.wait_for(Request.create(
+                    self, reader, writer,
+                    writer.get_extra_info('peername')),
+                    self.keep_alive_timeout)
+                if req is None:
+                    # the client closed the connection
+                    return False
+        except asyncio.TimeoutError:
+            return False
+        except OSError as exc:  # pragma: no cover
+            if exc.errno not in MUTED_SOCKET_ERRORS:
+                print_exception(exc)
+            return False
+        except Exception as exc:  # pragma: no cover
+            print_exception(exc)
+        requests += 1
+        if req is not None:
+            req.in_progress = True
+            self.requests_in_progress += 1
+
+        res = None
+        try:
+            metrics = self.metrics
+            if metrics is not None:
+                started = metrics.request_started()
+            res = await self.dispatch_request(req)
+            keep_alive = False
+            try:
+                if res != Response.already_handled:  # pragma: no branch
+                    keep_alive = self.keep_alive(req, res, requests)
+                    if hasattr(res.body, '__anext__') or \
+                            hasattr(res.body, '__next__'):
+                        # a streamed body can go on indefinitely
+                        self.long_lived(req)
+                    await res.write(writer, buf)
+            except OSError as exc:  # pragma: no cover
+                if exc.errno in MUTED_SOCKET_ERRORS:
+                    keep_alive = False
+                else:
+                    raise
+            if metrics is not None:
+                allocated = None
+                if req is not None and req.heap_start is not None:
+                    allocated = heap_allocated() - req.heap_start
+                    if allocated < 0:
+                        # the heap was collected meanwhile
+                        allocated = None
+                metrics.request_done(req, res, started, allocated)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+        finally:
+            self.long_lived(req)
+            self.release(req, res)
+        return keep_alive
+
+    def keep_alive(self, req, res, requests):
+        """Decide if the connection can be reused after this response, and
+        set the response's protocol version and ``Connection`` header
+        accordingly."""
+        if req is None:
+            return False
+        if req.http_version == '1.1':
+            res.http_version = '1.1'
+            keep_alive = 'close' not in req.headers.get(
+                'Connection', '').lower()
+        else:
+            keep_alive = 'keep-alive' in req.headers.get(
+                'Connection', '').lower()
+        res.complete()
+        if keep_alive and (
+                self.keep_alive_timeout <= 0 or
+                requests >= self.max_keep_alive_requests or
+                # an unread request body is still in the stream
+                req.content_length > Request.max_body_length or
+                req.content_length > req.max_content_length or
+                # the end of the response can only be signaled by closing
+                'Content-Length' not in res.headers):
+            keep_alive = False
+        if keep_alive:
+            res.headers['Connection'] = 'keep-alive'
+        elif req.http_version == '1.1' or 'Connection' in req.headers:
+            res.headers['Connection'] = 'close'
+        return keep_alive
+
+    def create_pools(self):
+        self.request_pool = Pool(self.pool_size)
+        self.response_pool = Pool(self.pool_size)
+        self.buffer_pool = Pool(self.pool_size)
+
+    def make_response(self, body='', status_code=200, headers=None,
+                      reason=None):
+        """Create the :class:`Response` for a handler's return value,
+        reusing one from the response pool if there is one."""
+        res = self.response_pool.get() if self.response_pool else None
+        if res is None:
+            res = Response(body, status_code, headers, reason)
+        else:
+            res.__init__(body, status_code, headers, reason)
+        res._pooled = self.response_pool is not None
+        return res
+
+    def release(self, req, res):
+        """Return a request, and a response made by :meth:`make_response`,
+        to their pools once the response has been sent. What they refer to
+        is dropped, so it can be collected while they wait to be reused."""
+        if self.request_pool is None:
+            return
+        if req is not None:
+            req.headers = req.g = req._body = req._stream = req.sock = None
+            req.after_request_handlers = None
+            self.request_pool.put(req)
+        if res is not None and res._pooled:
+            res.body = res.headers = None
+            res._pooled = False
+            self.response_pool.put(res)
+
+    def long_lived(self, req):
+        """Stop counting a request as in progress, so that it doesn't hold
+        off the garbage collection scheduled between requests. This is done
+        for streamed responses, and should be done by handlers that keep a
+        connection open, such as WebSocket handlers."""
+        if req is not None and req.in_progress:
+            req.in_progress = False
+            self.requests_in_progress -= 1
+
+    def collect_garbage(self):
+        """Run the garbage collector if :attr:`collect_threshold` bytes
+        have been allocated since it last ran here, and no request is in
+        progress. Called between requests."""
+        if self.collect_threshold is None or self.requests_in_progress:
+            return
+        allocated = heap_allocated()
+        if allocated is None:
+            return
+        if allocated < self.collected_heap:
+            # the heap was collected since
+            self.collected_heap = allocated
+        elif allocated - self.collected_heap >= self.collect_threshold:
+            started = time.ticks_us()
+            gc.collect()
+            self.collected_heap = heap_allocated()
+            if self.metrics is not None:
+                self.metrics.heap_collected(
+                    time.ticks_diff(time.ticks_us(), started))
 
     def get_request_handlers(self, req, attr, local_first=True):
         handlers = getattr(self, attr + '_handlers')
@@ -1415,11 +1946,12 @@ class Microdot:
                                 # if the status code is missing, assume 200
                                 status_code = 200
                                 headers = res[1]
-                            res = Response(body, status_code, headers)
+                            res = self.make_response(body, status_code,
+                                                     headers)
                         elif not isinstance(res, Response):
                             # any other response types are wrapped in a
                             # Response object
-                            res = Response(res)
+                            res = self.make_response(res)
 
                         # invoke the after request handlers
                         for handler in self.get_request_handlers(
@@ -1433,7 +1965,7 @@ class Microdot:
                     elif isinstance(f, dict):
                         # the response from an OPTIONS request is a dict with
                         # headers
-                        res = Response(headers=f)
+                        res = self.make_response(headers=f)
                     else:
                         # if the route is not found, return a 404 or 405
                         # response as appropriate
@@ -1479,9 +2011,9 @@ class Microdot:
             # if the request could not be parsed, issue a 400 error
             res = await self.error_response(req, 400, 'Bad request')
         if isinstance(res, tuple):
-            res = Response(*res)
+            res = self.make_response(*res)
         elif not isinstance(res, Response):
-            res = Response(res)
+            res = self.make_response(res)
         if not after_request_handled:
             # if the request did not finish due to an error, invoke the after
             # error request handler
@@ -0,0 +1,205 @@
+# planner.py - Pressure-dependent flow model used to plan valve pulses
+
+import hashlib
+import math
+import struct
+from array import array
+
+from flashfile import write_atomic
+
+# Pulse time for a target the model can never reach
+UNREACHABLE = float('inf')
+
+# Sanity bounds on a fitted rate constant (1/sec). Pulses implying a rate
+# outside them (a hose popped off, a sensor glitch) are not learned from,
+# and saved bands outside them are dropped at load time.
+K_MIN = 0.00001
+K_MAX = 1.0
+
+# Saved model file layout (little endian):
+#   header: magic, format version, model count, band count, band width (psi)
+#   per model: asymptote, then per band: log sum, time sum, pulse count
+#   trailer: first 4 bytes of the SHA-1 of everything before it
+MODEL_MAGIC = b'FLOW'
+MODEL_VERSION = 1
+HEADER_FORMAT = '<4sBBBf'
+MODEL_FORMAT = '<f'
+BAND_FORMAT = '<ffH'
+
+
+class FlowModel:
+    """Model of how the pressure moves while a valve is open.
+
+    Flow through an orifice falls off as the pressure difference across it
+    shrinks, so instead of a fixed PSI/sec rate the pressure is modelled as
+    an exponential approach toward ``asymptote`` (the supply pressure when
+    filling, or the pressure venting decays toward)::
+
+        dP/dt = k * (asymptote - P)
+
+    Every pulse gives the log of how much closer to the asymptote it moved
+    the pressure, which is ``k`` times the time the valve was open. ``k`` is
+    estimated as the ratio of the sums of those two quantities over the
+    pulses seen, with older pulses weighted down by ``forget`` each time so
+    the model follows changes such as the tank pressure dropping.
+
+    The fit is kept separately for each ``band_psi`` wide pressure band
+    (the last band is open-ended), since the real flow only roughly follows
+    the model. Bands that have not seen a pulse borrow the nearest fitted
+    band's ``k``.
+    """
+    __slots__ = ('asymptote', 'forget', 'band_psi', 'log_sum', 'time_sum',
+                 'pulses')
+
+    def __init__(self, asymptote, forget=0.7, band_psi=10, bands=5):
+        self.asymptote = asymptote
+        self.forget = forget
+        self.band_psi = band_psi
+        self.log_sum = array('f', [0.0] * bands)
+        self.time_sum = array('f', [0.0] * bands)
+        self.pulses = array('H', [0] * bands)
+
+    def band(self, psi):
+        i = int(psi // self.band_psi)
+        return min(max(i, 0), len(self.pulses) - 1)
+
+    def band_rate(self, i):
+        if self.pulses[i] == 0 or self.log_sum[i] <= 0:
+            return None
+        return self.log_sum[i] / self.time_sum[i]
+
+    def rate(self, psi):
+        """The fitted ``k`` (1/sec) around ``psi``, or ``None`` before the
+        first pulse."""
+        i = self.band(psi)
+        for d in range(len(self.pulses)):
+            for j in (i - d, i + d):
+                if 0 <= j < len(self.pulses):
+                    k = self.band_rate(j)
+                    if k is not None:
+                        return k
+        return None
+
+    def observe(self, p_before, p_after, seconds):
+        """Fit a pulse that moved the settled pressure from ``p_before`` to
+        ``p_after`` with the valve open for ``seconds``. Pulses that did not
+        move the pressure toward the asymptote, or imply an implausible
+        rate, are ignored; returns whether the pulse was used."""
+        a = self.asymptote
+        if seconds <= 0 or (a - p_after) * (a - p_before) <= 0:
+            return False
+        ratio = (a - p_before) / (a - p_after)
+        if ratio <= 1:
+            return False
+        x = math.log(ratio)
+        if not K_MIN <= x / seconds <= K_MAX:
+            return False
+        i = self.band((p_before + p_after) / 2)
+        self.log_sum[i] = self.log_sum[i] * self.forget + x
+        self.time_sum[i] = self.time_sum[i] * self.forget + seconds
+        self.pulses[i] = min(self.pulses[i] + 1, 0xffff)
+        return True
+
+    def predict(self, p_before, seconds):
+        """Settled pressure expected after opening the valve for
+        ``seconds``."""
+        k = self.rate(p_before)
+        if k is None:
+            return None
+        a = self.asymptote
+        return a + (p_before - a) * math.exp(-k * seconds)
+
+    def pulse_time(self, p_before, target):
+        """Seconds the valve needs to be open to move the pressure from
+        ``p_before`` to ``target``, ``None`` before the model has been fitted,
+        or ``UNREACHABLE`` if the target is at or beyond the asymptote."""
+        k = self.rate((p_before + target) / 2)
+        if k is None:
+            return None
+        a = self.asymptote
+        if (a - target) * (a - p_before) <= 0:
+            return UNREACHABLE
+        ratio = (a - p_before) / (a - target)
+        if ratio <= 1:
+            return 0.0
+        return math.log(ratio) / k
+
+
+def _digest(data):
+    return hashlib.sha1(data).digest()[:4]
+
+
+def save_models(filename, models):
+    """Write the fits of ``models`` to ``filename``. All models must have
+    the same band layout."""
+    first = models[0]
+    data = bytearray(struct.pack(HEADER_FORMAT, MODEL_MAGIC, MODEL_VERSION,
+                                 len(models), len(first.pulses),
+                                 first.band_psi))
+    for model in models:
+        data += struct.pack(MODEL_FORMAT, model.asymptote)
+        for i in range(len(model.pulses)):
+            data += struct.pack(BAND_FORMAT, model.log_sum[i],
+                                model.time_sum[i], model.pulses[i])
+    data += _digest(data)
+    write_atomic(filename, data)
+
+
+def load_models(filename, models):
+    """Restore the fits saved by :func:`save_models` into ``models``, which
+    must be given in the same order. Falls back to the ``.tmp`` copy left if
+    power was cut while saving. Returns ``False`` (leaving the models
+    untouched) if neither file is usable: missing, damaged, or written for a
+    different version or model layout.
+
+    A saved fit may come from another setup (another vehicle, tire count or
+    tank), so each band is restored with the weight of a single pulse: the
+    first pulses after a boot outweigh it. Callers should still not plan
+    long pulses from a restored model before a pulse has confirmed it.
+    """
+    return _load_file(filename, models) or \
+        _load_file(filename + '.tmp', models)
+
+
+def _load_file(filename, models):
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return False
+    header_size = struct.calcsize(HEADER_FORMAT)
+    model_size = struct.calcsize(MODEL_FORMAT)
+    band_size = struct.calcsize(BAND_FORMAT)
+    if len(data) < header_size + 4 or _digest(data[:-4]) != data[-4:]:
+        print('Ignoring damaged flow model file', filename)
+        return False
+    magic, version, count, bands, band_psi = struct.unpack_from(
+        HEADER_FORMAT, data)
+    if magic != MODEL_MAGIC or version != MODEL_VERSION or \
+            count != len(models) or \
+            len(data) != header_size + count * (
+                model_size + bands * band_size) + 4:
+        print('Ignoring flow model file', filename, 'with another layout')
+        return False
+    offset = header_size
+    for model in models:
+        asymptote = struct.unpack_from(MODEL_FORMAT, data, offset)[0]
+        offset += model_size
+        # A model saved for another band layout or asymptote doesn't apply
+        matches = bands == len(model.pulses) and \
+            band_psi == model.band_psi and \
+            abs(asymptote - model.asymptote) < 0.01
+        for i in range(bands):
+            log_sum, time_sum, pulses = struct.unpack_from(
+                BAND_FORMAT, data, offset)
+            offset += band_size
+            if not matches or pulses == 0 or time_sum <= 0:
+                continue
+            if not K_MIN <= log_sum / time_sum <= K_MAX:
+                continue
+            # Forgetting weights a long history of pulses at about
+            # 1 / (1 - forget); scale it down to one pulse
+            model.log_sum[i] = log_sum * (1 - model.forget)
+            model.time_sum[i] = time_sum * (1 - model.forget)
+            model.pulses[i] = pulses
+    return True
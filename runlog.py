@@ -0,0 +1,139 @@
+# runlog.py - Fixed-size records of each air up/air down run in a rotating file
+
+import struct
+
+try:
+    import os
+except ImportError:
+    import uos as os
+
+RECORD_VERSION = 1
+# version, direction, outcome, cancel source, run number, start time (s, on
+# the telemetry log's clock),
+# duration (ms), start/end/target PSI and overshoot (PSI * 100), valve open
+# time (ms), pulses, checksum
+RECORD = '<BbBBIIIHHHHIHH'
+RECORD_SIZE = struct.calcsize(RECORD)
+
+# Outcomes
+REACHED = 0
+OVERSHOT = 1
+CANCELLED = 2
+OUTCOMES = ('reached', 'overshot', 'cancelled')
+
+# Cancel sources; the names match commands.SOURCE_*
+SOURCES = (None, 'api', 'websocket', 'button')
+
+
+def _checksum(buf, offset):
+    total = 0
+    for i in range(offset, offset + RECORD_SIZE - 2):
+        total += buf[i]
+    return total & 0xffff
+
+
+def _centi(psi):
+    return min(max(int(psi * 100 + 0.5), 0), 0xffff)
+
+
+class RunLog:
+    """Keeps a record of every pressure run.
+
+    Each run is one ``RECORD_SIZE`` byte record. Run number ``n`` goes in
+    slot ``n % max_runs`` of a file created once at its full size, so the
+    file never grows and the oldest run is overwritten in place. A checksum
+    in every record catches one torn by a power cut.
+
+    The newest ``index_size`` records are also kept in RAM, in a
+    preallocated ring, so listing them never touches flash.
+    """
+
+    def __init__(self, filename, max_runs=256, index_size=20):
+        self.filename = filename
+        self.max_runs = max_runs
+        self.index = bytearray(index_size * RECORD_SIZE)
+        self.index_size = index_size
+        self.seq = 0            # number of the newest run
+        self.load()
+
+    def _valid(self, buf, offset):
+        if buf[offset] != RECORD_VERSION:
+            return 0
+        fields = struct.unpack_from(RECORD, buf, offset)
+        if fields[-1] != _checksum(buf, offset):
+            return 0
+        return fields[4]
+
+    def load(self):
+        """Find the newest run in the file and fill the index from it."""
+        size = self.max_runs * RECORD_SIZE
+        try:
+            if os.stat(self.filename)[6] != size:
+                raise OSError
+        except OSError:
+            try:
+                with open(self.filename, 'wb') as f:
+                    f.write(bytearray(size))
+            except OSError as e:
+                print('Error creating run log:', e)
+            return
+        buf = bytearray(32 * RECORD_SIZE)
+        with open(self.filename, 'rb') as f:
+            for first in range(0, self.max_runs, 32):
+                n = f.readinto(buf) // RECORD_SIZE
+                for i in range(n):
+                    self.seq = max(self.seq, self._valid(buf, i * RECORD_SIZE))
+            # The newest records, oldest first, into the index ring
+            for seq in range(max(self.seq - self.index_size + 1, 1),
+                             self.seq + 1):
+                f.seek((seq % self.max_runs) * RECORD_SIZE)
+                slot = (seq % self.index_size) * RECORD_SIZE
+                f.readinto(memoryview(self.index)[slot:slot + RECORD_SIZE])
+
+    def record(self, direction, outcome, source, start_s, duration_ms,
+               start_psi, end_psi, target_psi, overshoot, valve_ms, pulses):
+        """Add a run, returning its number."""
+        seq = self.seq + 1
+        slot = (seq % self.index_size) * RECORD_SIZE
+        struct.pack_into(RECORD, self.index, slot, RECORD_VERSION, direction,
+                         outcome, SOURCES.index(source), seq, start_s,
+                         duration_ms, _centi(start_psi), _centi(end_psi),
+                         _centi(target_psi), _centi(overshoot), valve_ms,
+                         min(pulses, 0xffff), 0)
+        struct.pack_into('<H', self.index, slot + RECORD_SIZE - 2,
+                         _checksum(self.index, slot))
+        self.seq = seq
+        with open(self.filename, 'r+b') as f:
+            f.seek((seq % self.max_runs) * RECORD_SIZE)
+            f.write(memoryview(self.index)[slot:slot + RECORD_SIZE])
+        return seq
+
+    def runs(self, limit=None, direction=None):
+        """The indexed runs as dicts, newest first."""
+        result = []
+        for seq in range(self.seq, max(self.seq - self.index_size, 0), -1):
+            if limit is not None and len(result) >= limit:
+                break
+            slot = (seq % self.index_size) * RECORD_SIZE
+            if self._valid(self.index, slot) != seq:
+                continue
+            (_, d, outcome, source, _, start_s, duration_ms, start_psi,
+             end_psi, target_psi, overshoot, valve_ms, pulses, _) = \
+                struct.unpack_from(RECORD, self.index, slot)
+            if direction is not None and d != direction:
+                continue
+            result.append({
+                'run': seq,
+                'direction': d,
+                'outcome': OUTCOMES[outcome],
+                'cancel_source': SOURCES[source],
+                'start': start_s,
+                'duration': duration_ms / 1000,
+                'start_psi': start_psi / 100,
+                'end_psi': end_psi / 100,
+                'target_psi': target_psi / 100,
+                'overshoot': overshoot / 100,
+                'valve_time': valve_ms / 1000,
+                'pulses': pulses,
+            })
+        return result
@@ -0,0 +1,73 @@
+# sampler.py - Background ADC acquisition into a preallocated ring buffer
+
+import time
+from array import array
+
+import lagmon
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class Sampler:
+    """Reads an ADC at a fixed rate from a background task.
+
+    Every tick takes ``oversample`` back-to-back readings and stores their
+    mean (in microvolts) in a ring buffer of ``size`` entries. A running sum
+    over the newest ``window`` entries is kept, so the filtered value is
+    available in O(1) without touching the ADC or allocating.
+    """
+
+    def __init__(self, adc, rate_hz=100, size=64, window=8, oversample=4):
+        if window > size:
+            raise ValueError('window larger than ring buffer')
+        self.adc = adc
+        self.period_ms = 1000 // rate_hz
+        self.size = size
+        self.window = window
+        self.oversample = oversample
+        self.buf = array('i', [0] * size)
+        self.index = 0      # next slot to be written
+        self.count = 0      # total samples taken, for change detection
+        self.total = 0      # sum of the newest `window` samples
+        self.last_ticks = time.ticks_ms()
+        # Fill the window synchronously so readers get a real value before
+        # the sampling task has run
+        for _ in range(window):
+            self.sample()
+
+    def sample(self):
+        raw = 0
+        for _ in range(self.oversample):
+            raw += self.adc.read_uv()
+        raw //= self.oversample
+        i = self.index
+        self.total += raw - self.buf[(i - self.window) % self.size]
+        self.buf[i] = raw
+        self.index = (i + 1) % self.size
+        self.count += 1
+        self.last_ticks = time.ticks_ms()
+
+    def latest(self):
+        """Newest unfiltered sample, in microvolts."""
+        return self.buf[(self.index - 1) % self.size]
+
+    def value(self):
+        """Mean of the newest ``window`` samples, in microvolts."""
+        return self.total // self.window
+
+    async def run(self):
+        deadline = time.ticks_ms()
+        while True:
+            self.sample()
+            lagmon.mark('sampler')
+            deadline = time.ticks_add(deadline, self.period_ms)
+            delay = time.ticks_diff(deadline, time.ticks_ms())
+            if delay < 0:
+                # Fell behind (long blocking handler); don't try to catch up
+                # with a burst of readings, just restart the schedule
+                deadline = time.ticks_ms()
+                delay = 0
+            await asyncio.sleep_ms(delay)
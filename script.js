@@ -1,16 +1,27 @@
-// Command state for Air Up/Down (local UI state)
+// Command state for Air Up/Down, as last reported by the firmware
 let airUpActive = false;
 let airDownActive = false;
+let lastState = null;
 
-// Track expected states to prevent flicker from slow status updates
-let airUpExpectedState = 'live';
-let airDownExpectedState = 'live';
+// Command ('air_up' or 'air_down') whose start or cancel hasn't been answered
+// yet; its button keeps showing the click until the reply arrives
+let pendingCommand = null;
 
-// Refresh pressure reading
-function refreshPressure() {
-    fetch('/pressure').then(r => r.json()).then(d => {
-        document.getElementById('pressure').innerText = parseInt(d.pressure) + ' psi';
-    });
+// Setpoints sent and waiting for the firmware's reply
+let pendingSetpoints = null;
+
+// WebSocket control channel, when connected
+let socket = null;
+
+let messageTimer = null;
+
+// Show a message from the firmware for a few seconds
+function showMessage(text) {
+    const el = document.getElementById('message');
+    el.textContent = text;
+    el.style.display = 'block';
+    clearTimeout(messageTimer);
+    messageTimer = setTimeout(() => { el.style.display = 'none'; }, 4000);
 }
 
 // Load setpoints from server
@@ -26,26 +37,47 @@ function loadSetpoints() {
 // Save setpoints with visual feedback
 function saveSetpoints() {
     const btn = document.querySelector('.save-setpoints');
-    const originalBg = btn.style.backgroundColor;
-    const originalColor = btn.style.color;
+    pendingSetpoints = {
+        onroad: document.getElementById('setpoint_onroad').value,
+        offroad: document.getElementById('setpoint_offroad').value,
+        bg: btn.style.backgroundColor,
+        color: btn.style.color
+    };
     btn.style.backgroundColor = '#bae5fdc4'; // mild baby blue
     btn.style.color = '#2563eb'; // blue text for contrast
     btn.style.fontWeight = 'bold';
     btn.disabled = true;
-    const s_onroad = document.getElementById('setpoint_onroad').value;
-    const s_offroad = document.getElementById('setpoint_offroad').value;
-    fetch('/set_setpoints', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({setpoint_onroad: s_onroad, setpoint_offroad: s_offroad})
-    }).then(() => {
-        btn.style.backgroundColor = originalBg;
-        btn.style.color = originalColor;
-        btn.disabled = false;
-        setpoint_onroad_last = s_onroad; // Update so buttons only update visually when saved
-        setpoint_offroad_last = s_offroad; // Update so buttons only update visually when saved
+    const msg = {setpoint_onroad: pendingSetpoints.onroad, setpoint_offroad: pendingSetpoints.offroad};
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        msg.type = 'set_setpoints';
+        socket.send(JSON.stringify(msg));
+    } else {
+        fetch('/set_setpoints', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(msg)
+        }).then(r => r.json()).then(finishSave,
+            () => finishSave({status: 'error', message: 'Setpoints not saved: no reply'}));
+    }
+}
 
-    });
+// Apply the firmware's reply to a setpoint save
+function finishSave(reply) {
+    const saved = pendingSetpoints;
+    if (!saved) {
+        return;
+    }
+    pendingSetpoints = null;
+    const btn = document.querySelector('.save-setpoints');
+    btn.style.backgroundColor = saved.bg;
+    btn.style.color = saved.color;
+    btn.disabled = false;
+    if (reply.status === 'ok') {
+        setpoint_onroad_last = saved.onroad; // Update so buttons only update visually when saved
+        setpoint_offroad_last = saved.offroad; // Update so buttons only update visually when saved
+    } else {
+        showMessage(reply.message || 'Setpoints not saved');
+    }
 }
 
 // Apply button visual changes immediately
@@ -77,40 +109,40 @@ function updateButtonVisuals(btn, state, elapsed) {
     }
 }
 
-// Set button state with flicker prevention
-function setButtonState(btn, state, elapsed, source) {
-    const isAirUp = btn.classList.contains('air-up');
-    const currentExpected = isAirUp ? airUpExpectedState : airDownExpectedState;
+// Send a start or cancel; the firmware's reply goes to finishCommand
+function sendCommand(cmd, action) {
+    pendingCommand = cmd;
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({type: action, cmd: cmd}));
+    } else {
+        fetch('/' + cmd + '?action=' + action, {method: 'POST'})
+            .then(r => r.json())
+            .then(finishCommand, () => finishCommand({
+                status: 'error', command: cmd, message: 'No reply from the controller'}));
+    }
+}
 
-    if (source === 'click') {
-        // Update immediately and set expected state
-        if (isAirUp) {
-            airUpExpectedState = state;
-        } else {
-            airDownExpectedState = state;
-        }
-        if (state === 'running') {
-            temp_state = 'starting';
-        } else if (state === 'idle') {
-            temp_state = 'cancelling';
+// Apply the firmware's reply to a start or cancel. The reply is what decides
+// the button: a state update sent before the firmware handled the click
+// doesn't move it, and a refused click puts it back as it was.
+function finishCommand(reply) {
+    if (pendingCommand === null || reply.command !== pendingCommand) {
+        return;
+    }
+    pendingCommand = null;
+    const btn = document.querySelector(reply.command === 'air_up' ? '.air-up' : '.air-down');
+    if (reply.status === 'started') {
+        setActive(btn, true, 0);
+    } else if (reply.status === 'cancelled' || reply.status === 'not_running') {
+        setActive(btn, false);
+    } else {
+        // busy, already_running or error: nothing changed
+        if (lastState) {
+            applyState(lastState);
         } else {
-            temp_state = state;
-        }
-        updateButtonVisuals(btn, temp_state, elapsed);
-    } else if (source === 'status' && currentExpected !== 'live') {
-        // Only update if status matches expected state or if we're not expecting anything
-        if (state === currentExpected) {
-            updateButtonVisuals(btn, state, elapsed);
-            // Clear expected state when status catches up
-            if (isAirUp) {
-                airUpExpectedState = 'live';
-            } else {
-                airDownExpectedState = 'live';
-            }
+            updateButtonVisuals(btn, 'idle');
         }
-    } else {
-        // Default behavior when live
-        updateButtonVisuals(btn, state, elapsed);
+        showMessage(reply.message || 'Command failed');
     }
 }
 
@@ -118,23 +150,17 @@ function setButtonState(btn, state, elapsed, source) {
 function airUp() {
     const btn = document.querySelector('.air-up');
     if (airDownActive) {
-        setButtonState(btn, 'blocked', undefined, 'click');
+        updateButtonVisuals(btn, 'blocked');
         return;
     }
     if (!airUpActive) {
-        // Start operation - update UI immediately
-        setButtonState(btn, 'running', 0, 'click');
-        fetch('/air_up?action=start', {method: 'POST'})
-            .then(response => response.json())
-            .then(data => {
-            });
+        // Start operation - show it until the firmware replies
+        updateButtonVisuals(btn, 'starting');
+        sendCommand('air_up', 'start');
     } else {
-        // Cancel operation - update UI immediately
-        setButtonState(btn, 'idle', undefined, 'click');
-        fetch('/air_up?action=cancel', {method: 'POST'})
-            .then(response => response.json())
-            .then(data => {
-            });
+        // Cancel operation - show it until the firmware replies
+        updateButtonVisuals(btn, 'cancelling');
+        sendCommand('air_up', 'cancel');
     }
 }
 
@@ -142,61 +168,110 @@ function airUp() {
 function airDown() {
     const btn = document.querySelector('.air-down');
     if (airUpActive) {
-        setButtonState(btn, 'blocked', undefined, 'click');
+        updateButtonVisuals(btn, 'blocked');
         return;
     }
     if (!airDownActive) {
-        // Start operation - update UI immediately
-        setButtonState(btn, 'running', 0, 'click');
-        fetch('/air_down?action=start', {method: 'POST'})
-            .then(response => response.json())
-            .then(data => {
-            });
+        // Start operation - show it until the firmware replies
+        updateButtonVisuals(btn, 'starting');
+        sendCommand('air_down', 'start');
     } else {
-        // Cancel operation - update UI immediately
-        setButtonState(btn, 'idle', undefined, 'click');
-        fetch('/air_down?action=cancel', {method: 'POST'})
-            .then(response => response.json())
-            .then(data => {
-            });
+        // Cancel operation - show it until the firmware replies
+        updateButtonVisuals(btn, 'cancelling');
+        sendCommand('air_down', 'cancel');
     }
 }
 
-// Poll firmware status when both commands are idle
-function pollFirmwareStatus() {
-    fetch('/air_up?action=status', {method: 'GET'})
-        .then(response => response.json())
-        .then(data => {
-            const btn = document.querySelector('.air-up');
-            if (data.status === 'running') {
-                airUpActive = true;
-                const elapsedTime = data.time || 0;
-                setButtonState(btn, 'running', elapsedTime, 'status');
-            } else {
-                airUpActive = false;
-                setButtonState(btn, 'idle', undefined, 'status');
-            }
-        });
-    fetch('/air_down?action=status', {method: 'GET'})
-        .then(response => response.json())
-        .then(data => {
-            const btn = document.querySelector('.air-down');
-            if (data.status === 'running') {
-                airDownActive = true;
-                const elapsedTime = data.time || 0;
-                setButtonState(btn, 'running', elapsedTime, 'status');
-            } else {
-                airDownActive = false;
-                setButtonState(btn, 'idle', undefined, 'status');
+// Record whether a command is running and show it on its button
+function setActive(btn, active, elapsed) {
+    if (btn.classList.contains('air-up')) {
+        airUpActive = active;
+    } else {
+        airDownActive = active;
+    }
+    updateButtonVisuals(btn, active ? 'running' : 'idle', active ? elapsed || 0 : undefined);
+}
+
+// Apply a firmware status report to a command button
+function applyStatus(btn, name, data) {
+    if (name === pendingCommand) {
+        // Sent before the firmware answered the click; the reply decides
+        return;
+    }
+    setActive(btn, data.status === 'running', data.time);
+}
+
+// Apply a state snapshot pushed by the firmware
+function applyState(d) {
+    lastState = d;
+    document.getElementById('pressure').innerText = parseInt(d.pressure) + ' psi';
+    applyStatus(document.querySelector('.air-up'), 'air_up', d.air_up);
+    applyStatus(document.querySelector('.air-down'), 'air_down', d.air_down);
+}
+
+// Poll the firmware state (fallback for browsers without EventSource)
+function pollState() {
+    fetch('/state').then(r => r.json()).then(applyState);
+}
+
+// Receive pressure and command state over a single long-lived connection
+function startEvents() {
+    if (!window.EventSource) {
+        // Refresh every 1000ms to avoid overwhelming the ESP32
+        setInterval(pollState, 1000);
+        pollState();
+        return;
+    }
+    const source = new EventSource('/events');
+    source.onmessage = function(e) {
+        applyState(JSON.parse(e.data));
+    };
+}
+
+// Send commands and receive their replies and state over one full-duplex
+// connection
+function connectSocket() {
+    const ws = new WebSocket('ws://' + location.host + '/ws');
+    let opened = false;
+    ws.onopen = function() {
+        opened = true;
+        socket = ws;
+    };
+    ws.onmessage = function(e) {
+        const d = JSON.parse(e.data);
+        if (d.type === 'state') {
+            applyState(d);
+        } else if (d.type === 'reply') {
+            if (d.request === 'set_setpoints') {
+                finishSave(d);
+            } else if (d.request === 'start' || d.request === 'cancel') {
+                finishCommand(d);
             }
-        });
+        }
+    };
+    ws.onclose = function() {
+        socket = null;
+        // Replies still outstanding won't arrive; the state sent after
+        // reconnecting shows what became of a command
+        pendingCommand = null;
+        finishSave({status: 'error', message: 'Connection lost; setpoints may not be saved'});
+        if (opened) {
+            // Dropped (e.g. phone went to sleep); reconnect
+            setTimeout(connectSocket, 1000);
+        } else {
+            // WebSockets don't get through; fall back to the event stream
+            startEvents();
+        }
+    };
 }
 
 // Initialize the app
 document.addEventListener('DOMContentLoaded', function() {
-    // Auto-refresh pressure every 1000ms to avoid overwhelming the ESP32
-    setInterval(refreshPressure, 1000);
-    setInterval(pollFirmwareStatus, 1000);
-    refreshPressure();
+    // The firmware pushes updates as they happen
+    if (window.WebSocket) {
+        connectSocket();
+    } else {
+        startEvents();
+    }
     loadSetpoints();
 });
@@ -0,0 +1,150 @@
+# setpoint_store.py - Setpoints cached in RAM with delayed, atomic flash writes
+
+import binascii
+import hashlib
+import time
+
+import ujson
+
+from flashfile import write_atomic
+import lagmon
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+FORMAT_VERSION = 1
+
+
+def checksum(seq, onroad, offroad):
+    """Short hex digest over the stored values. Floats are formatted to a
+    fixed precision so the result doesn't depend on how a port prints them."""
+    text = '%d:%d:%.2f:%.2f' % (FORMAT_VERSION, seq, onroad, offroad)
+    return binascii.hexlify(hashlib.sha1(text.encode()).digest()[:4]).decode()
+
+
+class SetpointStore:
+    """Holds the on-road/off-road setpoints in RAM.
+
+    The file is read once at boot and reads never touch flash. Updates are
+    written back by :meth:`run` once no further change has arrived for
+    ``write_delay_ms``, so a burst of edits costs one flash write, and an
+    update that doesn't change anything costs none.
+
+    Each write goes to ``<filename>.tmp`` first and is then renamed over the
+    real file, so a power cut leaves either the old or the new copy intact.
+    Records carry a format version, a sequence number and a checksum; at load
+    time the newest valid copy wins and a corrupt one is ignored. Files
+    without a checksum (hand-edited ones) are accepted as they are.
+    """
+
+    def __init__(self, filename, defaults=(32, 14), limits=(0, 300),
+                 write_delay_ms=2000):
+        self.filename = filename
+        self.limits = limits
+        self.tmp_filename = filename + '.tmp'
+        self.write_delay_ms = write_delay_ms
+        self.onroad, self.offroad = defaults
+        self.seq = 0
+        self.dirty = False
+        self.changed_ticks = 0
+        self.changed = asyncio.Event()
+        self.load()
+
+    def _read(self, filename):
+        """Parse one copy of the file, returning ``(seq, onroad, offroad)``
+        or ``None`` if it is missing or fails validation."""
+        try:
+            with open(filename) as f:
+                s = ujson.load(f)
+            onroad = self.check(s.get('setpoint_onroad', self.onroad))
+            offroad = self.check(s.get('setpoint_offroad', self.offroad))
+            seq = int(s.get('seq', 0))
+        except OSError:
+            return None
+        except Exception as e:
+            print('Error loading setpoints from', filename + ':', e)
+            return None
+        if s.get('version', FORMAT_VERSION) != FORMAT_VERSION:
+            print('Ignoring setpoints with unknown version in', filename)
+            return None
+        if 'checksum' in s and s['checksum'] != checksum(seq, onroad, offroad):
+            print('Ignoring corrupt setpoints in', filename)
+            return None
+        return seq, onroad, offroad
+
+    def load(self):
+        best = None
+        for filename in (self.filename, self.tmp_filename):
+            record = self._read(filename)
+            if record is not None and (best is None or record[0] > best[0]):
+                best = record
+        if best is None:
+            print('Using default setpoints')
+            return
+        self.seq, self.onroad, self.offroad = best
+
+    def get(self):
+        return self.onroad, self.offroad
+
+    def check(self, value):
+        """``value`` as a setpoint in PSI. Raises :exc:`ValueError` if it
+        isn't a number within ``limits``."""
+        try:
+            psi = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('setpoint is not a number: %r' % (value,))
+        # Also rejects nan
+        if not self.limits[0] <= psi <= self.limits[1]:
+            raise ValueError('setpoint out of range %d-%d PSI: %r'
+                             % (self.limits[0], self.limits[1], value))
+        return psi
+
+    def set(self, onroad, offroad):
+        """Update both setpoints. Raises :exc:`ValueError`, leaving the
+        stored values as they were, if either is invalid."""
+        onroad = self.check(onroad)
+        offroad = self.check(offroad)
+        if onroad == self.onroad and offroad == self.offroad:
+            return
+        self.onroad = onroad
+        self.offroad = offroad
+        self.dirty = True
+        self.changed_ticks = time.ticks_ms()
+        self.changed.set()
+
+    def flush(self):
+        """Write pending changes to flash now."""
+        if not self.dirty:
+            return
+        self.dirty = False
+        seq = self.seq + 1
+        # If power is lost while the temp copy is being renamed, it has the
+        # higher sequence number, so it is the one loaded at boot
+        write_atomic(self.filename, ujson.dumps({
+            'version': FORMAT_VERSION, 'seq': seq,
+            'setpoint_onroad': self.onroad,
+            'setpoint_offroad': self.offroad,
+            'checksum': checksum(seq, self.onroad, self.offroad)}))
+        self.seq = seq
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            # Hold off until the values have been left alone for a while
+            while True:
+                idle = time.ticks_diff(time.ticks_ms(), self.changed_ticks)
+                if idle >= self.write_delay_ms:
+                    break
+                await asyncio.sleep_ms(self.write_delay_ms - idle)
+            try:
+                self.flush()
+            except OSError as e:
+                print('Error saving setpoints:', e)
+                # Try again after another delay
+                self.dirty = True
+                self.changed_ticks = time.ticks_ms()
+                self.changed.set()
+            lagmon.mark('setpoints')
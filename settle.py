@@ -0,0 +1,183 @@
+# settle.py - Settle detection for pressure readings over a sliding window
+
+import math
+import time
+from array import array
+
+import lagmon
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Time constants (ms) tried when extrapolating a relaxation curve
+RELAXATION_TAUS_MS = (40, 60, 90, 130, 200, 300, 450, 700, 1000)
+
+
+class SettleDetector:
+    """Waits for a reading to stop moving.
+
+    ``read`` is called every ``period_ms`` and the newest ``window`` readings
+    are kept in preallocated arrays, timed with ``ticks_ms``. A least-squares
+    line through them gives the slope (units/sec) and the residual noise (the
+    standard deviation of the readings around the line). The reading is
+    settled once the window is full, the slope is under ``max_slope`` and the
+    noise is under ``max_noise``.
+
+    With ``max_error`` set, :meth:`wait` can also finish before the window
+    fills: from ``min_predict`` readings on, the readings since the wait
+    started are fitted with an exponential relaxation (see
+    :meth:`extrapolate`), and as soon as the value it is heading for is known
+    to within ``max_error`` that value is returned.
+
+    After :meth:`wait` returns, ``settled``, ``predicted``, ``settle_ms``,
+    ``slope``, ``noise`` and ``bound`` describe how it went.
+    """
+
+    def __init__(self, read, period_ms=50, window=10, max_slope=0.3,
+                 max_noise=0.1, max_error=None, min_predict=6):
+        if window < 3:
+            raise ValueError('window too small to fit')
+        self.read = read
+        self.period_ms = period_ms
+        self.max_slope = max_slope
+        self.max_noise = max_noise
+        self.max_error = max_error
+        self.min_predict = max(min_predict, 4)
+        self.times = array('i', [0] * window)    # ms since the wait started
+        self.values = array('f', [0.0] * window)
+        self.count = 0          # readings taken in the current wait
+        self.settled = False
+        self.predicted = False  # settled value came from extrapolate()
+        self.settle_ms = 0
+        self.slope = 0.0
+        self.noise = 0.0
+        self.value = 0.0        # fitted value at the newest reading
+        self.bound = 0.0        # uncertainty of an extrapolated value
+
+    def add(self, t_ms, value):
+        i = self.count % len(self.values)
+        self.times[i] = t_ms
+        self.values[i] = value
+        self.count += 1
+
+    def fit(self):
+        """Fit a line through the window, updating ``slope``, ``noise`` and
+        ``value``."""
+        n = min(self.count, len(self.values))
+        t_mean = 0.0
+        v_mean = 0.0
+        for i in range(n):
+            t_mean += self.times[i]
+            v_mean += self.values[i]
+        t_mean /= n
+        v_mean /= n
+        stt = 0.0
+        stv = 0.0
+        for i in range(n):
+            dt = self.times[i] - t_mean
+            stt += dt * dt
+            stv += dt * (self.values[i] - v_mean)
+        slope = stv / stt if stt > 0 else 0.0   # per ms
+        sse = 0.0
+        for i in range(n):
+            r = self.values[i] - v_mean - slope * (self.times[i] - t_mean)
+            sse += r * r
+        newest = self.times[(self.count - 1) % len(self.values)]
+        self.slope = slope * 1000
+        self.noise = math.sqrt(sse / (n - 2)) if n > 2 else 0.0
+        self.value = v_mean + slope * (newest - t_mean)
+
+    def extrapolate(self):
+        """Estimate where the readings since the wait started are heading.
+
+        Right after a valve closes the reading relaxes toward the settled
+        pressure roughly as ``value + b * exp(-t / tau)``. For each candidate
+        ``tau`` the line through ``exp(-t / tau)`` is fitted by least squares,
+        and the best fitting one gives the settled value. ``bound`` is twice
+        its standard error plus how far the neighbouring ``tau`` values'
+        estimates are from it, or infinite when the best ``tau`` is the
+        slowest one tried (the curve is too slow to extrapolate).
+
+        Only valid while the readings haven't wrapped around the window.
+        Returns the estimate.
+        """
+        n = self.count
+        t0 = self.times[0]
+        best = -1
+        best_sse = 0.0
+        estimates = []
+        for j, tau in enumerate(RELAXATION_TAUS_MS):
+            x_mean = 0.0
+            v_mean = 0.0
+            for i in range(n):
+                x_mean += math.exp((t0 - self.times[i]) / tau)
+                v_mean += self.values[i]
+            x_mean /= n
+            v_mean /= n
+            sxx = 0.0
+            sxv = 0.0
+            for i in range(n):
+                dx = math.exp((t0 - self.times[i]) / tau) - x_mean
+                sxx += dx * dx
+                sxv += dx * (self.values[i] - v_mean)
+            b = sxv / sxx
+            a = v_mean - b * x_mean
+            sse = 0.0
+            for i in range(n):
+                r = self.values[i] - a - \
+                    b * math.exp((t0 - self.times[i]) / tau)
+                sse += r * r
+            se = math.sqrt(sse / (n - 2) * (1 / n + x_mean * x_mean / sxx))
+            estimates.append((a, se))
+            if best < 0 or sse < best_sse:
+                best = j
+                best_sse = sse
+        a, se = estimates[best]
+        if best == len(RELAXATION_TAUS_MS) - 1:
+            self.bound = float('inf')
+        else:
+            spread = 0.0
+            for j in (best - 1, best + 1):
+                if j >= 0:
+                    spread = max(spread, abs(estimates[j][0] - a))
+            self.bound = 2 * se + spread
+        return a
+
+    async def wait(self, max_wait_ms):
+        """Read until settled or ``max_wait_ms`` has passed, and return the
+        fitted value at the newest reading."""
+        start = time.ticks_ms()
+        self.count = 0
+        self.settled = False
+        self.predicted = False
+        self.bound = 0.0
+        while True:
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            self.add(elapsed, self.read())
+            if self.max_error is not None and \
+                    self.min_predict <= self.count < len(self.values):
+                value = self.extrapolate()
+                if self.bound <= self.max_error:
+                    self.fit()
+                    self.value = value
+                    self.settled = True
+                    self.predicted = True
+                    break
+            if self.count >= len(self.values):
+                self.fit()
+                if abs(self.slope) < self.max_slope and \
+                        self.noise < self.max_noise:
+                    self.settled = True
+                    break
+            if elapsed >= max_wait_ms:
+                if self.count < len(self.values):
+                    self.fit()
+                break
+            lagmon.mark('settle')
+            # Keep readings on a fixed schedule, however long read() took
+            next_ms = self.count * self.period_ms
+            await asyncio.sleep_ms(max(next_ms - elapsed, 0))
+        self.settle_ms = time.ticks_diff(time.ticks_ms(), start)
+        return self.value
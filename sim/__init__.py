@@ -0,0 +1,83 @@
+"""
+sim
+---
+
+Host-side hardware simulator for the air down firmware. It provides
+stand-ins for the MicroPython ``machine``, ``network``, ``ujson`` and
+``uasyncio`` modules, wired to a physical model of the tires, manifold and
+compressor (see :mod:`sim.plant`), so that ``main.py`` runs unmodified under
+CPython.
+
+Run the firmware with::
+
+    python -m sim --port 8080
+"""
+import builtins
+import os
+import sys
+import time
+
+from sim import machine, network, uasyncio, ujson, utime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def print_exception(exc, file=None):
+    import traceback
+    traceback.print_exception(type(exc), exc, exc.__traceback__, file=file)
+
+
+async def invoke_handler(handler, *args, **kwargs):
+    # Same as microdot's MicroPython implementation. CPython's version runs
+    # sync handlers in a thread pool, which would hide any blocking they do
+    # from the event loop and let them race with the control tasks.
+    ret = handler(*args, **kwargs)
+    if hasattr(ret, 'send') and hasattr(ret, 'throw'):
+        ret = await ret
+    return ret
+
+
+def install(flash_root=ROOT, port=None):
+    """Install the simulated board into the running interpreter.
+
+    :param flash_root: The host directory that stands in for the root of the
+                       ESP32's flash filesystem. Absolute paths that do not
+                       exist on the host are looked up here, and it becomes
+                       the current directory.
+    :param port: If given, the HTTP server listens on this port instead of
+                 the one requested by the firmware.
+    """
+    for name, module in (('machine', machine), ('network', network),
+                         ('ujson', ujson), ('uasyncio', uasyncio),
+                         ('utime', time)):
+        sys.modules[name] = module
+    for name in ('ticks_ms', 'ticks_us', 'ticks_cpu', 'ticks_add',
+                 'ticks_diff', 'sleep_ms', 'sleep_us'):
+        setattr(time, name, getattr(utime, name))
+    sys.print_exception = print_exception
+
+    flash_root = os.path.abspath(flash_root)
+    host_open = builtins.open
+
+    def flash_open(file, *args, **kwargs):
+        if isinstance(file, str) and file.startswith('/') and \
+                not os.path.exists(file):
+            file = os.path.join(flash_root, file.lstrip('/'))
+        return host_open(file, *args, **kwargs)
+
+    builtins.open = flash_open
+    os.chdir(flash_root)
+    if flash_root not in sys.path:
+        sys.path.insert(0, flash_root)
+
+    import microdot
+    microdot.invoke_handler = invoke_handler
+    if port is not None:
+        start_server = microdot.Microdot.start_server
+
+        def start_server_on_port(self, host='0.0.0.0', _port=None,
+                                 **kwargs):
+            kwargs.pop('port', None)
+            return start_server(self, host=host, port=port, **kwargs)
+
+        microdot.Microdot.start_server = start_server_on_port
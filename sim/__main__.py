@@ -0,0 +1,119 @@
+"""Run ``main.py`` against the simulated board.
+
+Example::
+
+    python -m sim --port 8080 --tire-psi 14 --press up@5
+
+    # hold Air Down for 2 seconds (a long press) starting 8 seconds in
+    python -m sim --press down@8+2
+
+Unless ``--flash`` is given, the firmware runs from a scratch copy of the
+working tree, so what it writes to flash (setpoints, flow models, logs)
+never lands in the tree.
+"""
+import argparse
+import os
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+
+import sim
+from sim import machine, plant
+
+BUTTONS = {'up': 5, 'down': 16}
+
+
+def press(pin_id, at, hold=0.2, bounces=3):
+    def down():
+        # Mechanical contacts chatter for a millisecond or two when they close
+        for _ in range(bounces):
+            machine.set_level(pin_id, 0)
+            time.sleep(0.0005)
+            machine.set_level(pin_id, 1)
+            time.sleep(0.0005)
+        machine.set_level(pin_id, 0)
+        threading.Timer(hold, machine.set_level, (pin_id, 1)).start()
+
+    timer = threading.Timer(at, down)
+    timer.daemon = True
+    timer.start()
+
+
+def trace(interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            p = plant.current
+            p.advance()
+            print('[sim] tires {:.2f} psi, manifold {:.2f} psi, tank {:.1f} '
+                  'psi, fill {}, vent {}'.format(
+                      p.tire_psi, p.manifold_psi, p.tank_psi,
+                      'open' if p.fill_open else 'closed',
+                      'open' if p.vent_open else 'closed'))
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def scratch_flash():
+    """Create a temporary flash root seeded with the tree's top-level
+    files, and return its path."""
+    root = tempfile.mkdtemp(prefix='sim-flash-')
+    for name in os.listdir(sim.ROOT):
+        path = os.path.join(sim.ROOT, name)
+        if not name.startswith('.') and os.path.isfile(path):
+            shutil.copy2(path, root)
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port for the HTTP server (default: 8080)')
+    parser.add_argument('--flash', default=None,
+                        help='directory that stands in for the flash root '
+                             '(default: a scratch copy of the tree)')
+    parser.add_argument('--tire-psi', type=float, default=32.0)
+    parser.add_argument('--tank-psi', type=float, default=150.0)
+    parser.add_argument('--tire-volume', type=float, default=240.0,
+                        help='combined volume of the connected tires, in '
+                             'liters (default: four tires)')
+    parser.add_argument('--leak', type=float, default=0.0,
+                        help='conductance of a slow leak in the tires')
+    parser.add_argument('--noise', type=float, default=0.15,
+                        help='sensor noise standard deviation, in psi')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--adc-cost-us', type=int, default=0,
+                        help='time each ADC conversion blocks for')
+    parser.add_argument('--press', action='append', default=[],
+                        metavar='BUTTON@SECONDS[+HOLD]',
+                        help='press a button (up or down) at a given time, '
+                             'optionally holding it for HOLD seconds')
+    parser.add_argument('--trace', type=float, default=0,
+                        metavar='SECONDS',
+                        help='print the plant state at this interval')
+    args = parser.parse_args()
+
+    plant.current = plant.Plant(tire_psi=args.tire_psi,
+                                tank_psi=args.tank_psi,
+                                tire_volume=args.tire_volume,
+                                leak_conductance=args.leak,
+                                noise_psi=args.noise, seed=args.seed)
+    machine.ADC.read_cost_us = args.adc_cost_us
+    for p in args.press:
+        button, at = p.split('@')
+        at, _, hold = at.partition('+')
+        press(BUTTONS[button], float(at), float(hold or 0.2))
+    if args.trace:
+        trace(args.trace)
+
+    if args.flash is None:
+        args.flash = scratch_flash()
+        print('[sim] flash root', args.flash)
+    sim.install(flash_root=args.flash, port=args.port)
+    runpy.run_path(os.path.join(os.getcwd(), 'main.py'), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
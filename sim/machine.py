@@ -0,0 +1,137 @@
+"""
+sim.machine
+-----------
+
+Host-side stand-in for MicroPython's ``machine`` module. Only the parts used
+by the firmware are implemented. Output pins and the ADC are wired to the
+simulated plant the same way the relay shield and the pressure sensor are
+wired on the board.
+"""
+import time
+
+from sim import plant
+
+# Wiring (see the wiring diagram in README.md)
+FILL_PIN = 12
+VENT_PIN = 13
+PRESSURE_PIN = 32
+
+_outputs = {
+    FILL_PIN: lambda value: plant.current.set_fill(value),
+    VENT_PIN: lambda value: plant.current.set_vent(value),
+}
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    # Levels of all the pins, shared between Pin instances so that a test
+    # driver can act on a pin that was created by the firmware
+    levels = {}
+    # Interrupt (trigger, handler, pin) for each pin that has one
+    irqs = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        if value is not None:
+            self.value(value)
+        elif id not in Pin.levels:
+            Pin.levels[id] = 1 if pull == Pin.PULL_UP else 0
+
+    def value(self, x=None):
+        if x is None:
+            return Pin.levels[self.id]
+        Pin.levels[self.id] = 1 if x else 0
+        if self.id in _outputs:
+            _outputs[self.id](Pin.levels[self.id])
+
+    def __call__(self, x=None):
+        return self.value(x)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        if handler is None:
+            Pin.irqs.pop(self.id, None)
+        else:
+            Pin.irqs[self.id] = (trigger, handler, self)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def __repr__(self):
+        return 'Pin({})'.format(self.id)
+
+
+def set_level(pin_id, level):
+    """Drive an input pin from outside the firmware, for example to simulate
+    a button press (buttons are active low). Runs the pin's interrupt
+    handler if the change matches its trigger."""
+    level = 1 if level else 0
+    previous = Pin.levels.get(pin_id)
+    Pin.levels[pin_id] = level
+    if pin_id in Pin.irqs and level != previous:
+        trigger, handler, pin = Pin.irqs[pin_id]
+        if trigger & (Pin.IRQ_RISING if level else Pin.IRQ_FALLING):
+            handler(pin)
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+    WIDTH_9BIT = 0
+    WIDTH_10BIT = 1
+    WIDTH_11BIT = 2
+    WIDTH_12BIT = 3
+
+    #: Time in microseconds each conversion blocks the caller for. The ESP32
+    #: takes tens of microseconds per calibrated read.
+    read_cost_us = 0
+
+    def __init__(self, pin, atten=None):
+        self.pin = pin
+        self._atten = atten
+
+    def atten(self, value):
+        self._atten = value
+
+    def width(self, value):
+        pass
+
+    def read_uv(self):
+        if self.read_cost_us:
+            end = time.perf_counter() + self.read_cost_us / 1000000
+            while time.perf_counter() < end:
+                pass
+        if self.pin.id != PRESSURE_PIN:
+            return 0
+        return plant.current.read_uv()
+
+    def read_u16(self):
+        return min(self.read_uv() * 65535 // plant.SENSOR_MAX_UV, 65535)
+
+    def read(self):
+        return self.read_u16() >> 4
+
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+
+def freq(hz=None):
+    return 240000000
+
+
+def unique_id():
+    return b'\x00\x00\x00\x00\x00\x00'
@@ -0,0 +1,38 @@
+"""
+sim.network
+-----------
+
+Host-side stand-in for MicroPython's ``network`` module. The access point is
+always up; the HTTP server binds to the host's own interfaces.
+"""
+STA_IF = 0
+AP_IF = 1
+
+AUTH_OPEN = 0
+AUTH_WEP = 1
+AUTH_WPA_PSK = 2
+AUTH_WPA2_PSK = 3
+AUTH_WPA_WPA2_PSK = 4
+
+
+class WLAN:
+    def __init__(self, interface_id=STA_IF):
+        self.interface_id = interface_id
+        self._active = False
+        self._config = {}
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config.get(args[0])
+        self._config.update(kwargs)
+
+    def ifconfig(self):
+        return ('192.168.4.1', '255.255.255.0', '192.168.4.1', '0.0.0.0')
+
+    def isconnected(self):
+        return self._active
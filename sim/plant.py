@@ -0,0 +1,196 @@
+"""
+sim.plant
+---------
+
+Lumped-parameter model of the pneumatic side of the air down system: an air
+tank fed by a compressor, a fill solenoid and a vent solenoid opening into a
+small manifold, and the four tires hanging off that manifold through their
+fill hoses. The pressure sensor sits on the manifold, which is why readings
+wobble for a moment after a valve closes while the manifold and tires
+equalize.
+
+All pressures are gauge PSI. Gas quantities are tracked as absolute pressure
+times volume (PSI*L) so that flows between volumes are conserved.
+"""
+import math
+import random
+import time
+
+ATMOSPHERE_PSI = 14.7
+
+# Below this ratio of downstream/upstream absolute pressure the orifice is
+# choked and the flow no longer depends on the downstream pressure
+CHOKED_RATIO = 0.528
+
+# Sensor transfer function used by main.read_pressure():
+# psi = (uv - 500000) * 0.00005
+SENSOR_OFFSET_UV = 500000
+SENSOR_UV_PER_PSI = 20000
+# ESP32 ADC full scale with ATTN_11DB
+SENSOR_MAX_UV = 3150000
+
+
+def orifice_flow(conductance, p_up, p_down):
+    """Return the flow in PSI*L/s through an orifice between two gauge
+    pressures. The flow is positive from ``p_up`` to ``p_down``."""
+    if p_up < p_down:
+        return -orifice_flow(conductance, p_down, p_up)
+    up_abs = p_up + ATMOSPHERE_PSI
+    ratio = (p_down + ATMOSPHERE_PSI) / up_abs
+    if ratio < CHOKED_RATIO:
+        ratio = CHOKED_RATIO
+    return conductance * up_abs * math.sqrt(1.0 - ratio)
+
+
+def equalizing_transfer(p1, v1, p2, v2):
+    """Return the PSI*L that must move from volume 1 to volume 2 for both to
+    reach the same pressure. Used to clamp each integration step so that a
+    stiff connection can never overshoot."""
+    return (p1 - p2) * v1 * v2 / (v1 + v2)
+
+
+class Plant:
+    """Tire, manifold and compressor model.
+
+    :param tire_psi: Initial pressure of the tires (and manifold).
+    :param tank_psi: Initial pressure of the supply tank.
+    :param tire_volume: Combined volume of the connected tires, in liters.
+    :param manifold_volume: Volume of the manifold and sensor tee, in liters.
+    :param tank_volume: Volume of the supply tank, in liters.
+    :param fill_conductance: Orifice conductance of the fill solenoid.
+    :param vent_conductance: Orifice conductance of the vent solenoid.
+    :param hose_conductance: Conductance of the fill hoses between the
+                             manifold and the tires.
+    :param compressor_flow: Compressor output in PSI*L/s at the tank.
+    :param cut_in_psi: Tank pressure at which the compressor starts.
+    :param cut_out_psi: Tank pressure at which the compressor stops.
+    :param leak_conductance: Conductance of a slow leak from the tires to
+                             atmosphere. The default is no leak.
+    :param noise_psi: Standard deviation of the sensor noise, in PSI.
+    :param seed: Seed for the sensor noise generator.
+    :param clock: Callable returning the current time in seconds. The
+                  default is ``time.monotonic``.
+    """
+    step = 0.002
+
+    def __init__(self, tire_psi=32.0, tank_psi=150.0, tire_volume=240.0,
+                 manifold_volume=0.3, tank_volume=10.0, fill_conductance=1.6,
+                 vent_conductance=1.0, hose_conductance=4.0,
+                 compressor_flow=20.0, cut_in_psi=110.0, cut_out_psi=150.0,
+                 leak_conductance=0.0, noise_psi=0.15, seed=None,
+                 clock=time.monotonic):
+        self.tire_psi = float(tire_psi)
+        self.manifold_psi = float(tire_psi)
+        self.tank_psi = float(tank_psi)
+        self.tire_volume = tire_volume
+        self.manifold_volume = manifold_volume
+        self.tank_volume = tank_volume
+        self.fill_conductance = fill_conductance
+        self.vent_conductance = vent_conductance
+        self.hose_conductance = hose_conductance
+        self.compressor_flow = compressor_flow
+        self.cut_in_psi = cut_in_psi
+        self.cut_out_psi = cut_out_psi
+        self.leak_conductance = leak_conductance
+        self.noise_psi = noise_psi
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.fill_open = False
+        self.vent_open = False
+        self.compressor_on = self.tank_psi < self.cut_out_psi
+        #: Accumulated valve open time, in seconds.
+        self.fill_seconds = 0.0
+        self.vent_seconds = 0.0
+        self.last_time = clock()
+
+    def set_fill(self, state):
+        self.advance()
+        self.fill_open = bool(state)
+
+    def set_vent(self, state):
+        self.advance()
+        self.vent_open = bool(state)
+
+    def read_uv(self):
+        """Return a noisy sensor reading in microvolts, as the ADC would."""
+        self.advance()
+        psi = self.manifold_psi
+        if self.noise_psi:
+            psi += self.random.gauss(0.0, self.noise_psi)
+        uv = SENSOR_OFFSET_UV + psi * SENSOR_UV_PER_PSI
+        return int(min(max(uv, 0), SENSOR_MAX_UV))
+
+    def advance(self, now=None):
+        """Integrate the model up to ``now`` (by default the current time of
+        the clock)."""
+        if now is None:
+            now = self.clock()
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return
+        self.last_time = now
+        if self.fill_open:
+            self.fill_seconds += elapsed
+        if self.vent_open:
+            self.vent_seconds += elapsed
+        while elapsed > 0:
+            dt = self.step if elapsed > self.step else elapsed
+            elapsed -= dt
+            if self._is_idle():
+                # nothing moves between the volumes, so only the compressor
+                # and the leak need to be integrated for the remaining time
+                self._step_tank(elapsed + dt)
+                self._step_leak(elapsed + dt)
+                self.manifold_psi = self.tire_psi
+                break
+            self._step(dt)
+
+    def _is_idle(self):
+        return not self.fill_open and not self.vent_open and \
+            abs(self.manifold_psi - self.tire_psi) < 1e-4
+
+    def _transfer(self, conductance, p_up, v_up, p_down, v_down, dt):
+        flow = orifice_flow(conductance, p_up, p_down) * dt
+        limit = equalizing_transfer(p_up, v_up, p_down, v_down)
+        if abs(flow) > abs(limit):
+            flow = limit
+        return flow
+
+    def _step(self, dt):
+        vm = self.manifold_volume
+        vt = self.tire_volume
+        hose = self._transfer(self.hose_conductance, self.manifold_psi, vm,
+                              self.tire_psi, vt, dt)
+        fill = 0.0
+        if self.fill_open:
+            fill = self._transfer(self.fill_conductance, self.tank_psi,
+                                  self.tank_volume, self.manifold_psi, vm, dt)
+        vent = 0.0
+        if self.vent_open:
+            vent = orifice_flow(self.vent_conductance, self.manifold_psi,
+                                0.0) * dt
+            vent = min(vent, self.manifold_psi * vm)
+        self.tank_psi -= fill / self.tank_volume
+        self.manifold_psi += (fill - vent - hose) / vm
+        self.tire_psi += hose / vt
+        self._step_tank(dt)
+        self._step_leak(dt)
+
+    def _step_tank(self, dt):
+        if self.tank_psi <= self.cut_in_psi:
+            self.compressor_on = True
+        if self.compressor_on:
+            self.tank_psi += self.compressor_flow * dt / self.tank_volume
+            if self.tank_psi >= self.cut_out_psi:
+                self.tank_psi = self.cut_out_psi
+                self.compressor_on = False
+
+    def _step_leak(self, dt):
+        if self.leak_conductance and self.tire_psi > 0:
+            leak = orifice_flow(self.leak_conductance, self.tire_psi, 0.0) * dt
+            self.tire_psi -= min(leak, self.tire_psi * self.tire_volume) / \
+                self.tire_volume
+
+
+#: The plant instance the simulated ``machine`` module is wired to.
+current = Plant()
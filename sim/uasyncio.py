@@ -0,0 +1,48 @@
+"""
+sim.uasyncio
+------------
+
+Host-side stand-in for MicroPython's ``uasyncio`` module, built on top of
+CPython's ``asyncio`` with the MicroPython-only helpers added.
+"""
+from asyncio import *  # noqa: F401,F403
+from asyncio import Event, get_running_loop, sleep, wait_for
+
+
+async def sleep_ms(t):
+    await sleep(t / 1000)
+
+
+async def wait_for_ms(aw, timeout):
+    return await wait_for(aw, timeout / 1000)
+
+
+class ThreadSafeFlag:
+    """Flag that can be set from outside the event loop, such as from a pin
+    interrupt handler running in a driver thread. ``wait()`` clears it."""
+
+    def __init__(self):
+        self.event = Event()
+        self.loop = None
+
+    def set(self):
+        loop = self.loop
+        if loop is None:
+            self.event.set()
+            return
+        try:
+            running = get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.event.set()
+        else:
+            loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self):
+        self.loop = get_running_loop()
+        await self.event.wait()
+        self.event.clear()
@@ -0,0 +1,7 @@
+"""
+sim.ujson
+---------
+
+Host-side stand-in for MicroPython's ``ujson`` module.
+"""
+from json import dump, dumps, load, loads  # noqa: F401
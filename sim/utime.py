@@ -0,0 +1,45 @@
+"""
+sim.utime
+---------
+
+The MicroPython extensions to the ``time`` module. :func:`sim.install` adds
+them to CPython's ``time`` module, since the firmware calls them through
+``import time``.
+"""
+import time
+
+# MicroPython's ticks wrap around at 2**30 on the ESP32; keep that behavior
+# so that code that subtracts ticks directly instead of using ticks_diff()
+# misbehaves here too
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+
+def ticks_ms():
+    return time.monotonic_ns() // 1000000 & TICKS_MAX
+
+
+def ticks_us():
+    return time.monotonic_ns() // 1000 & TICKS_MAX
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALFPERIOD) & TICKS_MAX) - \
+        TICKS_HALFPERIOD
+
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    time.sleep(us / 1000000)
@@ -0,0 +1,289 @@
+# telemetry.py - Pressure log in a preallocated, rotating flash file
+
+import struct
+import time
+
+import lagmon
+
+try:
+    import os
+except ImportError:
+    import uos as os
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# The log file is a fixed number of fixed-size segments, each a header
+# followed by records. Unused record slots are erased (all bits set).
+SEGMENT_MAGIC = b'PLG2'
+# magic, sequence number, start time on the log's clock (s, ms), boot number
+SEGMENT_HEADER = '<4sIIHH'
+RECORD = '<HH'                # ms since the previous record, PSI * 100
+HEADER_SIZE = struct.calcsize(SEGMENT_HEADER)
+RECORD_SIZE = struct.calcsize(RECORD)
+ERASED = 0xffff
+# A record with this in place of the time starts a boot; its value is the
+# boot number (modulo ERASED), and the log's clock carries on from the
+# record before it
+BOOT = 0xfffe
+
+
+class TelemetryLog:
+    """Records the pressure to flash, bounded in both size and write rate.
+
+    The board has no clock that survives a power cut (``time.time()``
+    starts over at every cold boot), so times are on the log's own clock:
+    the uptime of every boot the log has seen, added up. Each boot appends
+    a :data:`BOOT` record to the newest segment and carries on from its last
+    record, so the clock never goes backwards and the time the board was
+    off doesn't count.
+
+    ``read`` is polled every ``sample_ms``. A reading is recorded when it
+    has moved by ``deadband`` PSI from the last recorded one, or when
+    ``max_interval_ms`` has passed without a record, so an idle system
+    writes one record a minute. Records are 4 bytes: the milliseconds since
+    the previous record and the PSI in hundredths.
+
+    Records are batched in a preallocated buffer of ``batch`` records and
+    written when it fills or every ``flush_ms``, whichever comes first; a
+    power cut loses at most that much. The file is created once at
+    ``max_bytes`` (rounded down to whole ``segment_size`` segments) and
+    never grows: each time a segment fills, the oldest segment is erased
+    and reused. Segment headers carry a sequence number that orders them,
+    the time their first record is relative to, and the boot they were
+    started in.
+    """
+
+    def __init__(self, filename, read, max_bytes=128 * 1024,
+                 segment_size=4096, sample_ms=1000, deadband=0.25,
+                 max_interval_ms=60000, flush_ms=30000, batch=64):
+        if max_interval_ms > BOOT - 1:
+            raise ValueError('max_interval_ms does not fit in a record')
+        self.filename = filename
+        self.read = read
+        self.segment_size = segment_size
+        self.segments = max(max_bytes // segment_size, 2)
+        self.capacity = (segment_size - HEADER_SIZE) // RECORD_SIZE
+        self.sample_ms = sample_ms
+        self.deadband = deadband
+        self.max_interval_ms = max_interval_ms
+        self.flush_ms = flush_ms
+        self.buf = bytearray(batch * RECORD_SIZE)
+        self.blank = b'\xff' * len(self.buf)
+        self.pending = 0        # records in buf
+        self.segment = -1       # index of the segment being written
+        self.seq = 0            # its sequence number
+        self.used = 0           # records already written to it
+        self.boot = 0           # number of this boot, set by open()
+        self.boot_ms = 0        # the log's clock when this boot started
+        self.uptime_ms = 0      # ms since boot, advanced by sample()
+        self.last_ticks = time.ticks_ms()
+        self.record_ms = 0      # uptime of the last record
+        self.last_psi = None
+        self.flushed_ticks = self.last_ticks
+
+    def segment_offset(self, index):
+        return index * self.segment_size
+
+    def open(self):
+        """Create the file if needed, then carry on from the last record of
+        the newest segment found in it, as a new boot."""
+        size = self.segments * self.segment_size
+        try:
+            ok = os.stat(self.filename)[6] == size
+        except OSError:
+            ok = False
+        if not ok:
+            print('Creating telemetry log', self.filename)
+            with open(self.filename, 'wb') as f:
+                for _ in range(size // len(self.blank)):
+                    f.write(self.blank)
+                f.write(memoryview(self.blank)[:size % len(self.blank)])
+        order = self.segment_order()
+        if not order:
+            self.boot = 1
+            self.start_segment()
+        else:
+            self.seq, self.segment, start_s, start_ms, boot = order[-1]
+            # Find the end of the newest segment, and the time and boot of
+            # its last record
+            t = start_s * 1000 + start_ms
+            used = 0
+            while True:
+                n = self.read_records(self.segment, used, self.buf)
+                if n == 0:
+                    break
+                for j in range(n):
+                    dt, value = struct.unpack_from(RECORD, self.buf,
+                                                   j * RECORD_SIZE)
+                    if dt == BOOT:
+                        boot = value
+                    else:
+                        t += dt
+                used += n
+            self.used = used
+            self.boot = boot % ERASED + 1
+            self.boot_ms = t
+            if self.used >= self.capacity:
+                self.start_segment()
+        # Written right away, so the next boot gets a new number even if
+        # this one is cut short
+        struct.pack_into(RECORD, self.buf, 0, BOOT, self.boot % ERASED)
+        self.pending = 1
+        self.flush()
+
+    def start_segment(self):
+        """Erase the segment after the current one and start writing it."""
+        self.segment = (self.segment + 1) % self.segments
+        self.seq += 1
+        self.used = 0
+        self.record_ms = self.uptime_ms
+        start = self.boot_ms + self.uptime_ms
+        header = struct.pack(SEGMENT_HEADER, SEGMENT_MAGIC, self.seq,
+                             start // 1000, start % 1000,
+                             self.boot % ERASED)
+        with open(self.filename, 'r+b') as f:
+            f.seek(self.segment_offset(self.segment))
+            f.write(header)
+            left = self.segment_size - HEADER_SIZE
+            while left > 0:
+                n = min(left, len(self.blank))
+                f.write(memoryview(self.blank)[:n])
+                left -= n
+
+    def sample(self):
+        """Poll the reading, recording it if it has changed enough."""
+        now = time.ticks_ms()
+        self.uptime_ms += time.ticks_diff(now, self.last_ticks)
+        self.last_ticks = now
+        psi = self.read()
+        dt = self.uptime_ms - self.record_ms
+        if self.last_psi is not None and dt < self.max_interval_ms and \
+                abs(psi - self.last_psi) < self.deadband:
+            return
+        centi = min(max(int(psi * 100 + 0.5), 0), ERASED - 1)
+        struct.pack_into(RECORD, self.buf, self.pending * RECORD_SIZE,
+                         min(dt, BOOT - 1), centi)
+        self.pending += 1
+        self.record_ms = self.uptime_ms
+        self.last_psi = psi
+        if self.used + self.pending >= self.capacity:
+            self.flush()
+            self.start_segment()
+        elif self.pending == len(self.buf) // RECORD_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the batched records to the current segment."""
+        self.flushed_ticks = time.ticks_ms()
+        if not self.pending:
+            return
+        n = self.pending
+        self.pending = 0
+        with open(self.filename, 'r+b') as f:
+            f.seek(self.segment_offset(self.segment) + HEADER_SIZE +
+                   self.used * RECORD_SIZE)
+            f.write(memoryview(self.buf)[:n * RECORD_SIZE])
+        self.used += n
+
+    def now_s(self):
+        """Current time on the log's clock, in seconds."""
+        ms = self.uptime_ms + time.ticks_diff(time.ticks_ms(), self.last_ticks)
+        return (self.boot_ms + ms) // 1000
+
+    def segment_order(self):
+        """``(seq, index, start_s, start_ms, boot)`` of each segment that
+        has been written, oldest first."""
+        found = []
+        header = bytearray(HEADER_SIZE)
+        try:
+            with open(self.filename, 'rb') as f:
+                for index in range(self.segments):
+                    f.seek(self.segment_offset(index))
+                    if f.readinto(header) != HEADER_SIZE:
+                        break
+                    magic, seq, start_s, start_ms, boot = struct.unpack(
+                        SEGMENT_HEADER, header)
+                    if magic == SEGMENT_MAGIC:
+                        found.append((seq, index, start_s, start_ms, boot))
+        except OSError:
+            return []
+        found.sort()
+        return found
+
+    def read_records(self, index, first, buf):
+        """Read records of a segment from number ``first`` on into ``buf``,
+        returning how many were written (the count stops at the first
+        erased slot)."""
+        count = min(len(buf) // RECORD_SIZE, self.capacity - first)
+        if count <= 0:
+            return 0
+        with open(self.filename, 'rb') as f:
+            f.seek(self.segment_offset(index) + HEADER_SIZE +
+                   first * RECORD_SIZE)
+            f.readinto(memoryview(buf)[:count * RECORD_SIZE])
+        for j in range(count):
+            if struct.unpack_from(RECORD, buf, j * RECORD_SIZE)[1] == ERASED:
+                return j
+        return count
+
+    def records(self, base_s, buf):
+        """Yield ``(ms, centi_psi)`` for every reading, oldest first, with
+        the time in ms since ``base_s``. Records still batched in RAM are
+        included; :data:`BOOT` records are not. ``buf`` is a scratch buffer
+        the file is read through.
+
+        Readers run between writes of the event loop, so the segment being
+        written is re-read until its flushed records are all consumed
+        before the batched ones are added.
+        """
+        for seq, index, start_s, start_ms, _ in self.segment_order():
+            t = (start_s - base_s) * 1000 + start_ms
+            k = 0
+            while True:
+                n = self.read_records(index, k, buf)
+                if n == 0:
+                    break
+                for j in range(n):
+                    dt, centi = struct.unpack_from(RECORD, buf, j * RECORD_SIZE)
+                    if dt != BOOT:
+                        t += dt
+                        yield t, centi
+                k += n
+            if seq == self.seq and k == self.used and self.pending:
+                pending = bytes(memoryview(self.buf)[:self.pending *
+                                                     RECORD_SIZE])
+                for j in range(len(pending) // RECORD_SIZE):
+                    dt, centi = struct.unpack_from(RECORD, pending,
+                                                   j * RECORD_SIZE)
+                    if dt != BOOT:
+                        t += dt
+                        yield t, centi
+
+    async def run(self):
+        try:
+            self.open()
+        except OSError as e:
+            print('Error opening telemetry log:', e)
+            return
+        deadline = time.ticks_ms()
+        while True:
+            try:
+                self.sample()
+                if time.ticks_diff(time.ticks_ms(),
+                                   self.flushed_ticks) >= self.flush_ms:
+                    self.flush()
+            except OSError as e:
+                # Drop the batch rather than retrying a failing flash write
+                # every second
+                print('Error writing telemetry log:', e)
+                self.pending = 0
+            lagmon.mark('telemetry')
+            deadline = time.ticks_add(deadline, self.sample_ms)
+            delay = time.ticks_diff(deadline, time.ticks_ms())
+            if delay < 0:
+                deadline = time.ticks_ms()
+                delay = 0
+            await asyncio.sleep_ms(delay)
@@ -0,0 +1,168 @@
+"""Build a single-file page bundle for the firmware to serve.
+
+The page normally takes five requests to load (layout, stylesheet, script,
+icon and background image). This script inlines a minified stylesheet and
+script into ``layout.html``, embeds the background image as a data URI
+(downscaled and recompressed first when Pillow is installed), and writes
+``bundle.html`` and a gzip-compressed ``bundle.html.gz``. ``main.py`` serves
+the bundle as ``/`` when it is present on the flash, so a freshly joined
+phone loads the interface with one small transfer.
+
+Usage::
+
+    python tools/build_bundle.py [--image-width 800] [--image-quality 60]
+
+Upload ``bundle.html`` and ``bundle.html.gz`` to the ESP32 along with the
+other files. Re-run the script whenever the page, stylesheet, script or
+images change.
+"""
+import argparse
+import base64
+import binascii
+import gzip
+import hashlib
+import io
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read(name, mode='r'):
+    with open(os.path.join(ROOT, name), mode) as f:
+        return f.read()
+
+
+def strip_comments(source, line_comments=True):
+    """Remove /* */ (and optionally //) comments, leaving string literals
+    alone."""
+    out = []
+    i = 0
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c in '\'"`':
+            j = i + 1
+            while j < n and source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j + 1])
+            i = j + 1
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif line_comments and source.startswith('//', i):
+            end = source.find('\n', i)
+            i = n if end < 0 else end
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def minify_css(css):
+    css = strip_comments(css, line_comments=False)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    # Conservative: comments and indentation go, but line breaks stay so
+    # that automatic semicolon insertion keeps working
+    js = strip_comments(js)
+    lines = [line.strip() for line in js.splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def minify_html(html):
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.S)
+    html = re.sub(r'>\s+<', '><', html)
+    return re.sub(r'\s+', ' ', html).strip()
+
+
+def optimize_image(data, width, quality):
+    """Downscale and recompress a JPEG. Returns the original bytes if Pillow
+    is not installed or the result is not smaller."""
+    try:
+        from PIL import Image
+    except ImportError:
+        print('Pillow not installed; background image left as is',
+              file=sys.stderr)
+        return data
+    img = Image.open(io.BytesIO(data))
+    if img.width > width:
+        img = img.resize((width, img.height * width // img.width),
+                         Image.LANCZOS)
+    out = io.BytesIO()
+    img.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True,
+                            progressive=True)
+    out = out.getvalue()
+    return out if len(out) < len(data) else data
+
+
+def version(data):
+    # Same scheme as AssetCache.url() in assets.py
+    return binascii.hexlify(hashlib.sha1(data).digest()[:8]).decode()
+
+
+def build(image_width, image_quality):
+    html = read('layout.html')
+    css = read('style.css')
+    js = read('script.js')
+    image = read('tire.jpeg', 'rb')
+    icon = read('icon.png', 'rb')
+
+    optimized = optimize_image(image, image_width, image_quality)
+    data_uri = 'data:image/jpeg;base64,' + base64.b64encode(
+        optimized).decode()
+    css = minify_css(css.replace('./tire.jpeg', data_uri))
+    js = minify_js(js)
+
+    # Minify the page before inlining, so the script keeps its line breaks
+    html = minify_html(html)
+    html = html.replace("<link rel='stylesheet' href='./style.css'>",
+                        '<style>' + css + '</style>')
+    html = html.replace("<script src='/script.js'></script>",
+                        '<script>' + js + '</script>')
+    html = html.replace("href='./icon.png'",
+                        "href='/icon.png?v=" + version(icon) + "'")
+    if 'style.css' in html or 'script.js' in html:
+        raise RuntimeError('layout.html references were not all inlined')
+    bundle = html.encode()
+    bundle_gz = gzip.compress(bundle, compresslevel=9, mtime=0)
+
+    with open(os.path.join(ROOT, 'bundle.html'), 'wb') as f:
+        f.write(bundle)
+    with open(os.path.join(ROOT, 'bundle.html.gz'), 'wb') as f:
+        f.write(bundle_gz)
+
+    rows = [
+        ('layout.html', len(read('layout.html', 'rb'))),
+        ('style.css', len(read('style.css', 'rb'))),
+        ('script.js', len(read('script.js', 'rb'))),
+        ('tire.jpeg', len(image)),
+    ]
+    print('{:<24}{:>10}{:>10}'.format('file', 'bytes', 'gzip'))
+    for name, size in rows:
+        gz = len(gzip.compress(read(name, 'rb'), compresslevel=9, mtime=0))
+        print('{:<24}{:>10}{:>10}'.format(name, size, gz))
+    print('{:<24}{:>10}{:>10}'.format(
+        'inputs total', sum(size for _, size in rows), ''))
+    print('{:<24}{:>10}'.format('tire.jpeg (optimized)', len(optimized)))
+    print('{:<24}{:>10}{:>10}'.format('bundle.html', len(bundle),
+                                      len(bundle_gz)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--image-width', type=int, default=800,
+                        help='maximum width of the background image')
+    parser.add_argument('--image-quality', type=int, default=60,
+                        help='JPEG quality of the background image')
+    args = parser.parse_args()
+    build(args.image_width, args.image_quality)
+
+
+if __name__ == '__main__':
+    main()